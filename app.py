@@ -1,5 +1,10 @@
 import logging
 from utils import *
+from harvester import Harvester
+from scheduler import PollScheduler
+from importer import ImportJob
+from response_cache import ResponseCache
+from events import EventServer
 
 
 def run_web_server():
@@ -10,10 +15,48 @@ def run_web_server():
 
     startup_time = get_current_time()
 
+    page_cache = ResponseCache(config.get_web_cache_size())
+    # ETags of the pages change with the server too, a restart may bring new templates or settings
+    etag_prefix = generate_id()
+
+    def get_page_offset():
+        return (int(request.query.get('page', 1)) - 1) * config.get_images_per_page()
+
+    def etag_matches(etag):
+        if_none_match = request.headers.get('If-None-Match', "")
+        return etag in [value.strip().removeprefix("W/") for value in if_none_match.split(",")] or \
+            if_none_match.strip() == "*"
+
+    def cached_page(render):
+        # Gallery pages only change with the catalog: each one is rendered once per
+        # catalog generation, and browsers revalidate it with the generation ETag
+        from bottle import response, HTTPResponse
+
+        generation = get_database_generation()
+        headers = {'ETag': f'"{etag_prefix}-{generation}"', 'Cache-Control': "no-cache"}
+        if etag_matches(headers['ETag']):
+            return HTTPResponse(status=304, **headers)
+
+        key = (request.urlparts.scheme, request.urlparts.netloc, request.path, request.query_string)
+        body = page_cache.get(key, generation)
+        headers['X-Cache'] = "HIT" if body is not None else "MISS"
+        if body is None:
+            body = render(generation).encode('utf-8')
+            page_cache.put(key, generation, body)
+
+        for name, value in headers.items():
+            response.set_header(name, value)
+
+        return body
+
     @app.route('/')
     def index():
-        images = read_images_database()
-        return template_and_search_terms(startup_time, "Latest downloaded images", images, "/")
+        def render(generation):
+            images, _ = query_images_database(offset=get_page_offset())
+            return template_and_search_terms(startup_time, "Latest downloaded images", images, "/",
+                                             count_images_database(), generation)
+
+        return cached_page(render)
 
     @app.route('/search')
     def search():
@@ -21,29 +64,121 @@ def run_web_server():
 
         search_term = request.query.get('search-term').encode('latin1').decode('utf-8').strip()
 
-        image_list = search_term_database(search_term)
-        len_images = len(image_list)
-        text = f"{len_images} {'images' if len_images != 1 else 'image'} found with '{search_term}' term"
+        def render(generation):
+            len_images = count_query_images_database('search', search_term)
+            image_list, _ = query_images_database('search', search_term, offset=get_page_offset())
+            text = f"{len_images} {'images' if len_images != 1 else 'image'} found with '{search_term}' term"
 
-        return template_and_search_terms(startup_time, text, image_list, f"/search?search-term={quote(search_term)}")
+            return template_and_search_terms(startup_time, text, image_list,
+                                             f"/search?search-term={quote(search_term)}", len_images)
+
+        return cached_page(render)
 
     @app.route('/random')
     def index():
-        from random import sample
+        seed = request.query.get('seed', "").strip()
+        if not seed:
+            return template_and_search_terms(startup_time, "Some random images", random_images_database(), "/random")
 
-        images = read_images_database()
-        nmax = min(config.get_images_per_page(), len(images))
+        # Shuffle session: the pages of the seed are fixed, so they are cached too
+        from urllib.parse import quote
 
-        return template_and_search_terms(startup_time, "Some random images", sample(images, nmax), "/random")
+        try:
+            size = max(1, int(request.query.get('size', "")))
+        except ValueError:
+            size = max(1, count_images_database())
+
+        def render(generation):
+            images = random_images_database(seed=seed, size=size, offset=get_page_offset())
+            return template_and_search_terms(startup_time, "Shuffled images", images,
+                                             f"/random?seed={quote(seed)}&size={size}", min(size, count_images_database()))
+
+        return cached_page(render)
+
+    @app.route('/shuffle')
+    def shuffle():
+        from bottle import redirect
+
+        # The size keeps the pages of the session stable while new images arrive
+        redirect(f"/random?seed={generate_id()}&size={count_images_database()}")
 
     @app.route('/new')
     def index():
         id_new = request.query.get('id').strip()
 
-        inserted_images = search_id_database(id_new)
-        text = f'{len(inserted_images)} new images has been uploaded'
+        def render(generation):
+            len_images = count_query_images_database('id-new', id_new)
+            inserted_images, _ = query_images_database('id-new', id_new, offset=get_page_offset())
+            text = f'{len_images} new images has been uploaded'
+
+            return template_and_search_terms(startup_time, text, inserted_images, f"/new?id={id_new}", len_images)
+
+        return cached_page(render)
+
+    def get_api_images(field=None, value=None):
+        # JSON pages of images: ?limit=&cursor= (next_cursor of the previous
+        # page), ?fields= to choose the fields, ?total=1 to count them all
+        from bottle import response
+
+        try:
+            limit = min(max(int(request.query.get('limit', config.get_images_per_page())), 1),
+                        config.get_api_max_limit())
+            images, next_cursor = query_images_database(field, value, limit, request.query.get('cursor') or None)
+        except ValueError as error:
+            response.status = 400
+            return {'error': str(error)}
+
+        fields = [name.strip() for name in request.query.get('fields', "").split(",") if name.strip()]
+        if fields:
+            images = [{name: image[name] for name in fields if name in image} for image in images]
+
+        result = {'images': images, 'next_cursor': next_cursor}
+        if request.query.get('total', "").lower() in ["1", "true", "yes"]:
+            result['total'] = count_query_images_database(field, value)
+
+        return result
+
+    @app.route('/api/images')
+    def api_images():
+        return get_api_images()
+
+    @app.route('/api/images/search')
+    def api_search():
+        return get_api_images('search', request.query.getunicode('q', "").strip())
+
+    @app.route('/api/images/new/<id_new>')
+    def api_new(id_new):
+        return get_api_images('id-new', id_new)
+
+    @app.route('/api/images/country/<country>')
+    def api_country(country):
+        return get_api_images('country', country)
+
+    @app.route('/api/images/folder/<folder>')
+    def api_folder(folder):
+        return get_api_images('folder', folder)
+
+    @app.route('/events')
+    def events():
+        from bottle import redirect, abort
+
+        # Served by the event server, one thread for all the subscribers
+        if not config.get_events_port():
+            abort(404, "Events are disabled")
+
+        query = f"?{request.query_string}" if request.query_string else ""
+        events_url = config.get_events_url() or \
+            f"{request.urlparts.scheme}://{request.urlparts.hostname}:{config.get_events_port()}/events"
+        redirect(events_url + query, 307)
+
+    @app.route('/api/cache')
+    def api_cache():
+        # Counters of the page cache of this process (each prefork worker has its own)
+        import os
+        from bottle import response
 
-        return template_and_search_terms(startup_time, text, inserted_images, f"/new?id={id_new}")
+        response.headers['Cache-Control'] = "no-store"
+        return dict(page_cache.stats(), pid=os.getpid(), generation=get_database_generation())
 
     @app.route('/upload')
     def index():
@@ -55,22 +190,18 @@ def run_web_server():
 
     @app.route('/downloadImages')
     def download():
-        from bottle import static_file, response
-        import os
-        import tempfile
+        from bottle import response
         import time
 
-        tmp_dir = tempfile.mkdtemp()
-
         timestamp = time.strftime("%Y%m%d%H%M%S")
         filename = f"images-{timestamp}.zip"
-        filepath = f'{tmp_dir}/{filename}'
 
-        compress_directory(config.get_output_dir(), filepath)
+        export_images_database()
 
+        # The archive is sent while it is built, no temp file
         response.headers['Content-Type'] = 'application/octet-stream'
         response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-        return static_file(filename, root=os.path.dirname(filepath), download=filename)
+        return stream_directory_zip(config.get_output_dir(), exclude=get_backup_excluded_files())
 
     @app.route('/uploadFile', method='POST')
     def upload():
@@ -82,52 +213,131 @@ def run_web_server():
         upload = request.files.get('filename')
         filename = upload.filename
         if '.zip' in filename:
-            tmp_dir = tempfile.mkdtemp()
-            logger.debug(f"Temp path: {tmp_dir}")
-            file_path = os.path.join(tmp_dir, filename)
-            upload.save(file_path)
+            file_descriptor, file_path = tempfile.mkstemp(prefix="spotlight-dl-", suffix=".zip")
+            logger.debug(f"Temp file: {file_path}")
+            with os.fdopen(file_descriptor, 'wb') as file:
+                upload.save(file)
 
             id_new = generate_id()
-            decompress_zipfile(file_path, tmp_dir)
-            insert_images_from_backup(tmp_dir, id_new)
+            ImportJob(file_path, id_new).start()
 
-            delete_directory(tmp_dir)
-            redirect(f'/new?id={id_new}')
+            redirect(f'/importing?id={id_new}')
 
         else:
             error_message = 'The uploaded file is not a zip file!'
             return template('error.html', error_message=error_message)
 
+    @app.route('/importing')
+    def importing():
+        return template('import.html', id_new=request.query.get('id', "").strip())
+
+    @app.route('/import/<id_new>')
+    def import_status(id_new):
+        from bottle import response
+
+        status = ImportJob.read_status(id_new)
+        if status is None:
+            response.status = 404
+            return {'error': "Import not found"}
+
+        response.headers['Cache-Control'] = "no-store"
+        return status
+
     @app.route('/image/<hash>')
     def get_image(hash):
         import os
-        from bottle import response
+        from bottle import static_file, response, HTTPResponse
 
         logger = logging.getLogger("image")
-        images = search_digest_database(hash)
+        image_path = get_local_image_path(hash)
+
+        if image_path is None:
+            response.status = 404
+            return template('error.html', error_message="Image not found!")
+
+        # The URL is the digest of the image, so it is cached for good. Only the
+        # EXIF tags can change for a digest (metadata upgrades), the mtime in the
+        # ETag keeps it a strong validator for range requests.
+        stat = os.stat(image_path)
+        headers = {'ETag': f'"{hash}-{stat.st_mtime_ns:x}"', 'Cache-Control': "public, max-age=31536000, immutable"}
+        if etag_matches(headers['ETag']):
+            return HTTPResponse(status=304, **headers)
+
+        logger.debug(f"Reading image from {image_path} ...")
+
+        # static_file streams the file (sendfile through wsgi.file_wrapper) and
+        # answers If-Modified-Since and Range requests
+        image_response = static_file(os.path.basename(image_path), root=os.path.dirname(image_path),
+                                     mimetype='image/jpeg')
+        if image_response.status_code < 400:
+            for name, value in headers.items():
+                image_response.set_header(name, value)
+
+        return image_response
+
+    @app.route('/thumb/<hash>/<size:int>')
+    def get_thumbnail(hash, size):
+        import os
+        from bottle import static_file, response, redirect, HTTPResponse
+        from thumbnails import make_thumbnail, get_thumbnail_path, touch_thumbnail
 
-        try:
-            if len(images) == 0:
-                raise Exception("Image not found!")
+        logger = logging.getLogger("thumb")
+
+        if size not in config.get_thumbnail_sizes():
+            response.status = 404
+            return template('error.html', error_message="Thumbnail size not available!")
 
-            image_path = images[0]['image_full_path']
-            logger.info(f"Reading image from {image_path} ...")
+        headers = {'ETag': f'"{hash}-{size}"', 'Cache-Control': "public, max-age=31536000, immutable"}
+        if etag_matches(headers['ETag']):
+            return HTTPResponse(status=304, **headers)
 
-            if not os.path.isfile(image_path):
-                raise Exception("Image file not found!")
+        thumbnail_path = get_thumbnail_path(hash, size)
+        if os.path.isfile(thumbnail_path):
+            touch_thumbnail(thumbnail_path)
+        else:
+            image_path = get_local_image_path(hash)
+            if image_path is None:
+                image = get_image_catalog().get(hash)
+                if image and image['image_url_landscape'].startswith("http"):
+                    # The file is not in the library, the original URL is all there is
+                    redirect(image['image_url_landscape'])
+                response.status = 404
+                return template('error.html', error_message="Image not found!")
+
+            try:
+                thumbnail_path = make_thumbnail(image_path, hash, size)
+            except BaseException as error:
+                logger.error(f"Error making the thumbnail of {image_path}: {error}")
+                redirect(f"/image/{hash}")
+
+        thumbnail_response = static_file(os.path.basename(thumbnail_path), root=os.path.dirname(thumbnail_path),
+                                         mimetype='image/jpeg')
+        if thumbnail_response.status_code < 400:
+            for name, value in headers.items():
+                thumbnail_response.set_header(name, value)
+
+        return thumbnail_response
 
-            response.content_type = 'image/jpeg'
+    TEMPLATE_PATH.append('./templates')
 
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
+    # The catalog and the links are loaded before the server starts, so prefork
+    # workers inherit them instead of reading the database each
+    count_images_database()
+    get_links()
 
-            return image_data
+    server = config.get_web_server()
+    if server == "threaded":
+        app.run(server='waitress', host='0.0.0.0', port=int(config.get_port()), threads=config.get_web_threads(),
+                backlog=config.get_web_backlog())
+    elif server == "prefork":
+        app.run(server='gunicorn', host='0.0.0.0', port=int(config.get_port()), workers=config.get_web_workers(),
+                threads=config.get_web_threads(), backlog=config.get_web_backlog(), preload_app=True)
+    else:
+        app.run(host='0.0.0.0', port=int(config.get_port()))
 
-        except BaseException as e:
-            return template('error.html', error_message=e)
 
-    TEMPLATE_PATH.append('./templates')
-    app.run(host='0.0.0.0', port=config.get_port())
+def run_event_server():
+    EventServer(AppConfig.get_events_port()).serve_forever()
 
 
 def main():
@@ -145,24 +355,60 @@ def main():
     server_process = multiprocessing.Process(target=run_web_server)
     server_process.start()
 
+    if AppConfig.get_events_port():
+        # In its own process, not a thread of the web server: it takes the catalog
+        # locks, and a prefork worker forked while one of them is held would never get it
+        multiprocessing.Process(target=run_event_server, name="events", daemon=True).start()
+
     logger.info(f"Web Server started ...")
 
     setup_output_dir()
     initial_sleep()
 
+    harvester = Harvester() if AppConfig.is_harvester_enabled() else None
+    scheduler = PollScheduler() if AppConfig.is_scheduler_enabled() else None
+
     try:
         n = 1
         images = count_images_database()
 
         while True:
             logger.info(f"Iteration {n} - Images {images} ...")
-            for item in get_images_data():
-                if process_image(item):
+            stats = {}
+            if harvester:
+                items = harvester.harvest(scheduler)
+            elif scheduler:
+                country, pid = scheduler.choose_target()
+                items = get_images_data(country, pid)
+            else:
+                items = get_images_data()
+
+            for item, new_image in process_images(items, stats):
+                if harvester:
+                    harvester.record(item, new_image)
+
+                if new_image:
                     images = images + 1
                     send_new_image_email_notification(item, images)
                     send_new_image_telegram_notification(item, images)
 
-            sleep()
+            logger.info(f"Iteration {n}: {get_download_stats_message(stats)}")
+            if harvester:
+                harvester.log_yields()
+                harvester.save_yields()
+
+            if scheduler:
+                if harvester:
+                    for target_key, new_images in harvester.iteration_new.items():
+                        scheduler.record(target_key, 1, new_images)
+                    requests = len(harvester.iteration_new)
+                else:
+                    scheduler.record(scheduler.get_target_key(country, pid), 1, stats['new'])
+                    requests = 1
+
+                scheduler.sleep(requests, stats['new'])
+            else:
+                sleep()
             n = n + 1
 
     except BaseException as e:
@@ -0,0 +1,364 @@
+import logging
+import os
+import time
+
+from utils import *
+
+
+def make_record(digest, title, description="", timestamp=None):
+    return {'image_url_landscape': f"./image/{digest}", 'title': title, 'description': description,
+            'copyright': "", 'country': "ES", 'country_name': "Spain", 'hex_digest': digest,
+            'image_path': f"Benchmark/{digest}.jpg", 'timestamp': timestamp or get_now()}
+
+
+def write_database(directory, records):
+    import json
+
+    os.makedirs(f"{directory}/Benchmark", exist_ok=True)
+    with open(get_json_database_name(directory), 'w') as file:
+        file.write("".join(json.dumps(record) + "\n" for record in records))
+
+
+def make_library(directory, images, prefix="lib"):
+    records = [make_record(f"{prefix}{i:032d}"[-32:], "Benchmark", "Some description") for i in range(images)]
+    write_database(directory, records)
+    return records
+
+
+def make_backup(directory, images, overlap, library):
+    # A backup with `overlap` images already in the library and the rest new ones
+    records = [dict(record) for record in library[:overlap]]
+    records += [make_record(f"bak{i:032d}"[-32:], "Benchmark", "Some description") for i in range(images - overlap)]
+    write_database(directory, records)
+
+    for record in records:
+        with open(f"{directory}/{record['image_path']}", 'wb') as file:
+            file.write(b"\xff\xd8\xff\xd9")
+
+    return records
+
+
+def make_backup_archive(directory, archive_path):
+    # The backup directory as the zip uploaded to /upload
+    import zipfile
+
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_STORED) as archive:
+        for root, _, files in os.walk(directory):
+            for file in files:
+                archive.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), directory))
+
+
+def legacy_exists_image(json_image, json_database):
+    # exists_image() as it was before the catalog: parse, sort and scan the file per call
+    from datetime import datetime
+    import json
+
+    images_json = {}
+    with open(json_database, 'r') as file:
+        for line in file:
+            json_line = json.loads(line)
+            images_json[json_line['hex_digest']] = json_line
+
+    database = sorted(images_json.values(), reverse=True,
+                      key=lambda x: datetime.strptime(x['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'))
+
+    for json_line in database:
+        if json_line['hex_digest'] == json_image['hex_digest']:
+            if (json_line['title'] == "Unknown" and json_line['title'] != json_image['title'] or
+                    json_line['description'] == "" and json_image['description'] != ""):
+                return False
+            return True
+
+    return False
+
+
+def benchmark_import(library_images, backup_images, overlap, legacy_sample):
+    import tempfile
+    from importer import ImportJob
+
+    logger = logging.getLogger("benchmark_import")
+    work_dir = tempfile.mkdtemp()
+    output_dir = f"{work_dir}/library"
+    backup_dir = f"{work_dir}/backup"
+
+    os.environ['SPOTLIGHTDL_GENERAL_OUTPUT_DIR'] = output_dir
+    init_configuration()
+
+    library = make_library(output_dir, library_images)
+    backup = make_backup(backup_dir, backup_images, overlap, library)
+    make_backup_archive(backup_dir, f"{work_dir}/backup.zip")
+    logger.info(f"Importing {backup_images} images ({overlap} duplicated) into a {library_images} images library")
+
+    # Before: one full database parse and scan per backup image, measured on a sample
+    json_database = get_json_database_name()
+    sample = backup[:legacy_sample]
+    start = time.perf_counter()
+    for image in sample:
+        legacy_exists_image(image, json_database)
+    legacy_per_image = (time.perf_counter() - start) / max(len(sample), 1)
+    legacy_total = legacy_per_image * backup_images
+    logger.info(f"Before: {legacy_per_image * 1000:.2f} ms per image, "
+                f"~{legacy_total:.1f} s estimated for {backup_images} images (sampled {len(sample)})")
+
+    # After: the import job of /upload, run in this thread
+    job = ImportJob(f"{work_dir}/backup.zip", generate_id())
+    os.makedirs(job.get_jobs_dir(), exist_ok=True)
+    start = time.perf_counter()
+    job.run()
+    total = time.perf_counter() - start
+    if job.status['state'] != "done":
+        logger.error(f"Import failed: {job.status['message']}")
+    logger.info(f"After: {total * 1000 / backup_images:.3f} ms per image, {total:.2f} s for {backup_images} images")
+    logger.info(f"Speedup: x{legacy_total / total:.0f}")
+
+    delete_directory(work_dir)
+
+
+def benchmark_search(library_images, queries):
+    import random
+    import statistics
+    import tempfile
+
+    logger = logging.getLogger("benchmark_search")
+    work_dir = tempfile.mkdtemp()
+    output_dir = f"{work_dir}/library"
+
+    os.environ['SPOTLIGHTDL_GENERAL_OUTPUT_DIR'] = output_dir
+    init_configuration()
+
+    words = ["lake", "mountain", "beach", "forest", "castle", "desert", "island", "river", "canyon", "glacier",
+             "Italy", "Spain", "Norway", "Japan", "Iceland", "Chile", "Peru", "Kenya", "Canada", "Greece"]
+    random.seed(1)
+    records = [make_record(f"lib{i:032d}"[-32:], f"{random.choice(words)} {i}, {random.choice(words)}",
+                           f"A view of the {random.choice(words)} near the {random.choice(words)}")
+               for i in range(library_images)]
+    write_database(output_dir, records)
+
+    start = time.perf_counter()
+    count_images_database()
+    logger.info(f"Catalog with {library_images} images loaded in {time.perf_counter() - start:.2f} s")
+
+    per_page = AppConfig.get_images_per_page()
+    terms = ["lake", "gla", "lake ital", "norway castle", "kenya 123", "zzz"]
+    for term in terms:
+        timings = []
+        for page in range(queries):
+            # Drop cached results so every first page is measured cold
+            get_image_catalog().clear_search_cache()
+            start = time.perf_counter()
+            count_search_term_database(term)
+            search_term_database(term, per_page, 0)
+            timings.append(time.perf_counter() - start)
+
+        page_timings = []
+        for page in range(queries):
+            start = time.perf_counter()
+            count_search_term_database(term)
+            search_term_database(term, per_page, page * per_page)
+            page_timings.append(time.perf_counter() - start)
+
+        logger.info(f"'{term}': {count_search_term_database(term)} images, "
+                    f"median {statistics.median(timings) * 1000:.3f} ms first page, "
+                    f"{statistics.median(page_timings) * 1000:.3f} ms next pages")
+
+    delete_directory(work_dir)
+
+
+def legacy_save_image(image_json, image_data):
+    # save_image() + tag_image() as they were: decode and re-encode with PIL,
+    # then read the file back and write it again with the EXIF tags
+    from io import BytesIO
+    from PIL import Image
+    import exif
+
+    make_image_directory(image_json)
+    Image.open(BytesIO(image_data)).save(image_json['image_full_path'])
+
+    with open(image_json['image_full_path'], 'rb') as file:
+        img = exif.Image(file)
+
+    img.image_description = image_json['description']
+    img.copyright = image_json['copyright']
+
+    with open(image_json['image_full_path'], 'wb') as file:
+        file.write(img.get_file())
+
+
+def benchmark_save(images, width, height):
+    import tempfile
+    from io import BytesIO
+    from PIL import Image
+
+    logger = logging.getLogger("benchmark_save")
+    work_dir = tempfile.mkdtemp()
+
+    os.environ['SPOTLIGHTDL_GENERAL_OUTPUT_DIR'] = f"{work_dir}/library"
+    init_configuration()
+
+    # A detailed synthetic picture, so the JPEG is close to a real photo in size
+    picture = Image.effect_mandelbrot((width, height), (-2.2, -1.2, 1.0, 1.2), 256).convert("RGB")
+    buffer = BytesIO()
+    picture.save(buffer, "JPEG", quality=92)
+    image_data = buffer.getvalue()
+    logger.info(f"Saving {images} images of {width}x{height} ({len(image_data) / 1024:.0f} KB)")
+
+    def make_image_json(i, prefix):
+        return {'title': "Benchmark", 'description': "A description", 'copyright': "(c) Benchmark",
+                'hex_digest': f"{prefix}{i:029d}"}
+
+    start = time.process_time()
+    for i in range(images):
+        legacy_save_image(make_image_json(i, "old"), image_data)
+    legacy_cpu = (time.process_time() - start) / images
+
+    start = time.process_time()
+    for i in range(images):
+        # Stands for the temp file written by the streaming download
+        image_file = f"{work_dir}/download.jpg"
+        with open(image_file, 'wb') as file:
+            file.write(image_data)
+
+        image_json = make_image_json(i, "new")
+        image_json['image_file'] = image_file
+        save_image(image_json)
+        discard_image_data(image_json)
+    cpu = (time.process_time() - start) / images
+
+    logger.info(f"Before: {legacy_cpu * 1000:.2f} ms CPU per image (decode, encode, tag rewrite)")
+    logger.info(f"After: {cpu * 1000:.2f} ms CPU per image (original bytes, in-memory tags, one write)")
+
+    delete_directory(work_dir)
+
+
+def percentiles(timings):
+    import statistics
+
+    if len(timings) < 2:
+        timings = list(timings) * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(timings, n=100, method="inclusive")
+    return f"p50 {cuts[49] * 1000:.1f} ms, p90 {cuts[89] * 1000:.1f} ms, p99 {cuts[98] * 1000:.1f} ms"
+
+
+def benchmark_ingest(library_images, iterations, items, duplicate_ratio, latency, size, min_rate):
+    # The main loop ingest path (request, download, save and tag, database
+    # append) against a local stand-in of the Spotlight endpoint
+    import tempfile
+    import utils
+    from mock_spotlight import MockSpotlight
+
+    logger = logging.getLogger("benchmark_ingest")
+    work_dir = tempfile.mkdtemp()
+    output_dir = f"{work_dir}/library"
+
+    mock = MockSpotlight(items, duplicate_ratio, latency, size * 1024, seed=1)
+    base_url = mock.start()
+
+    os.environ['SPOTLIGHTDL_GENERAL_OUTPUT_DIR'] = output_dir
+    os.environ['SPOTLIGHTDL_SPOTLIGHT_URL'] = mock.get_placement_url(base_url)
+    init_configuration()
+
+    make_library(output_dir, library_images)
+    logger.info(f"Ingesting {iterations} responses of {items} items ({duplicate_ratio:.0%} duplicates, "
+                f"{size} KB, {latency * 1000:.0f} ms latency) into a {library_images} images library")
+
+    timings = {'request': [], 'download': [], 'store': []}
+
+    def timed(stage, function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings[stage].append(time.perf_counter() - start)
+        return wrapper
+
+    # process_images() looks these up in the utils module
+    utils.download_image = timed('download', utils.download_image)
+    utils.store_image = timed('store', utils.store_image)
+    utils.store_known_image = timed('store', utils.store_known_image)
+
+    totals = {'items': 0, 'new': 0, 'errors': 0, 'bytes': 0, 'skipped': 0}
+    start = time.perf_counter()
+    for _ in range(iterations):
+        request_start = time.perf_counter()
+        images_data = list(get_images_data())
+        timings['request'].append(time.perf_counter() - request_start)
+
+        stats = {}
+        for _ in process_images(images_data, stats):
+            pass
+
+        for key in totals:
+            totals[key] += stats[key]
+    elapsed = time.perf_counter() - start
+
+    rate = totals['items'] / elapsed
+    logger.info(f"{totals['new']}/{totals['items']} new images, {totals['skipped']} known images skipped, "
+                f"{totals['errors']} errors in {elapsed:.2f} s")
+    logger.info(f"{rate:.1f} images/s, {totals['bytes'] / 1024 / 1024 / elapsed:.2f} MB/s downloaded, "
+                f"{count_images_database()} images in the library")
+    for stage, stage_timings in timings.items():
+        logger.info(f"{stage}: {len(stage_timings)} calls, {percentiles(stage_timings)}")
+
+    mock.stop()
+    delete_directory(work_dir)
+
+    if totals['errors'] or rate < min_rate:
+        logger.error(f"Ingest below the gate: {rate:.1f} images/s (minimum {min_rate}), {totals['errors']} errors")
+        return False
+
+    return True
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="spotlight-dl benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Backup import into an existing library")
+    import_parser.add_argument("--library", type=int, default=50000)
+    import_parser.add_argument("--backup", type=int, default=10000)
+    import_parser.add_argument("--overlap", type=int, default=2000)
+    import_parser.add_argument("--legacy-sample", type=int, default=20)
+
+    search_parser = subparsers.add_parser("search", help="/search queries on a large library")
+    search_parser.add_argument("--library", type=int, default=100000)
+    search_parser.add_argument("--queries", type=int, default=50)
+
+    save_parser = subparsers.add_parser("save", help="CPU time to save and tag a downloaded image")
+    save_parser.add_argument("--images", type=int, default=50)
+    save_parser.add_argument("--width", type=int, default=1920)
+    save_parser.add_argument("--height", type=int, default=1080)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Main loop ingest against a local Spotlight stand-in")
+    ingest_parser.add_argument("--library", type=int, default=20000)
+    ingest_parser.add_argument("--iterations", type=int, default=50)
+    ingest_parser.add_argument("--items", type=int, default=4)
+    ingest_parser.add_argument("--duplicate-ratio", type=float, default=0.8)
+    ingest_parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every response")
+    ingest_parser.add_argument("--size", type=int, default=500, help="Image size in KB")
+    ingest_parser.add_argument("--min-rate", type=float, default=0.0,
+                               help="Fail (exit status 1) below this many images/s")
+
+    args = parser.parse_args()
+
+    conf_logging()
+    for name in ["import_backup", "copy_file", "delete_directory", "process_image", "store_known_image",
+                 "add_image_to_database", "mock_spotlight"]:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    if args.command == "import":
+        benchmark_import(args.library, args.backup, args.overlap, args.legacy_sample)
+    elif args.command == "search":
+        benchmark_search(args.library, args.queries)
+    elif args.command == "save":
+        benchmark_save(args.images, args.width, args.height)
+    elif args.command == "ingest":
+        if not benchmark_ingest(args.library, args.iterations, args.items, args.duplicate_ratio, args.latency,
+                                args.size, args.min_rate):
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
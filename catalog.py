@@ -0,0 +1,1048 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class TokenIndex:
+    # Inverted index from lowercase tokens to hex_digests. Queries match every
+    # word as a token prefix (AND), using a sorted vocabulary to find the range
+    # of tokens sharing the prefix.
+
+    def __init__(self):
+        self.postings = {}
+        self.record_tokens = {}
+        self.vocabulary = []
+        # Tokens not merged into the sorted vocabulary yet
+        self.added_tokens = set()
+        self.removed_tokens = set()
+
+    @staticmethod
+    def tokenize(text):
+        import re
+
+        return re.findall(r"\w+(?:['-]\w+)*", text.lower())
+
+    @staticmethod
+    def get_record_tokens(json_image):
+        fields = [json_image['title'], json_image['description'], json_image.get('copyright', ""),
+                  json_image.get('country_name', ""), json_image['hex_digest'], json_image['timestamp']]
+
+        # Folder names built by make_image_directory()
+        fields += json_image.get('image_path', "").split("/")[:-1]
+
+        return set(TokenIndex.tokenize(" ".join(fields)))
+
+    def add(self, hex_digest, json_image):
+        self.remove(hex_digest)
+
+        tokens = self.get_record_tokens(json_image)
+        for token in tokens:
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = set()
+                if token in self.removed_tokens:
+                    self.removed_tokens.discard(token)
+                else:
+                    self.added_tokens.add(token)
+            postings.add(hex_digest)
+
+        self.record_tokens[hex_digest] = tokens
+
+    def remove(self, hex_digest):
+        for token in self.record_tokens.pop(hex_digest, ()):
+            postings = self.postings[token]
+            postings.discard(hex_digest)
+            if not postings:
+                del self.postings[token]
+                if token in self.added_tokens:
+                    self.added_tokens.discard(token)
+                else:
+                    self.removed_tokens.add(token)
+
+    def update_vocabulary(self):
+        # Every new image brings new tokens (its digest and timestamp): a few
+        # changes are merged into the sorted vocabulary, many (the first load)
+        # sort it again
+        from bisect import bisect_left, insort
+
+        changes = len(self.added_tokens) + len(self.removed_tokens)
+        if changes > len(self.vocabulary) // 16:
+            self.vocabulary = sorted(self.postings)
+        else:
+            for token in self.removed_tokens:
+                del self.vocabulary[bisect_left(self.vocabulary, token)]
+            for token in self.added_tokens:
+                insort(self.vocabulary, token)
+
+        self.added_tokens.clear()
+        self.removed_tokens.clear()
+
+    def prefix_matches(self, prefix):
+        from bisect import bisect_left
+
+        if self.added_tokens or self.removed_tokens:
+            self.update_vocabulary()
+
+        start = bisect_left(self.vocabulary, prefix)
+        end = bisect_left(self.vocabulary, prefix + "\uffff", start)
+
+        if end - start == 1:
+            return self.postings[self.vocabulary[start]]
+
+        return set().union(*(self.postings[token] for token in self.vocabulary[start:end]))
+
+    def search(self, search_term):
+        # Returns None when there is nothing to search for (every image matches)
+        words = self.tokenize(search_term)
+        if not words:
+            return None
+
+        # Intersect starting with the most selective word, without copying postings
+        matches = sorted((self.prefix_matches(word) for word in set(words)), key=len)
+        result = matches[0]
+        for word_matches in matches[1:]:
+            if not result:
+                break
+            result = result & word_matches
+
+        return result
+
+
+class SharedCatalogState:
+    # Generation of the JSONL log shared by the downloader and the web server:
+    # a memory-mapped file with a counter that writers bump, under a file lock,
+    # after every change of the log. Readers compare it with the generation
+    # they have loaded, a memory read, and only then look at the log. The size
+    # and mtime of the log after the last change are kept too, so a log
+    # changed while no process was running is noticed on startup.
+    magic = b"SPDLGEN1"
+    # magic, generation, log size, log mtime_ns
+    layout = "<8sQQQ"
+
+    def __init__(self, state_file, json_database):
+        self.state_file = state_file
+        self.json_database = json_database
+        self.pid = None
+        # Nested lock() calls: check_log() runs inside changing() from compact()
+        self.lock_depth = 0
+        self.open()
+        self.check_log()
+
+    def open(self):
+        # Locks belong to the open file, so a forked process opens its own
+        import mmap
+        import os
+        import struct
+
+        if self.pid is not None:
+            self.memory.close()
+            os.close(self.file_descriptor)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+        self.file_descriptor = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o644)
+        self.pid = os.getpid()
+        self.lock_depth = 0
+
+        size = struct.calcsize(self.layout)
+        self.lock()
+        try:
+            if os.read(self.file_descriptor, len(self.magic)) != self.magic or \
+                    os.fstat(self.file_descriptor).st_size < size:
+                os.pwrite(self.file_descriptor, struct.pack(self.layout, self.magic, 0, 0, 0), 0)
+            self.memory = mmap.mmap(self.file_descriptor, size)
+        finally:
+            self.unlock()
+
+    def check_process(self):
+        import os
+
+        if self.pid != os.getpid():
+            self.open()
+
+    def lock(self):
+        # Re-entrant: flock is not counted, an inner unlock would release the outer lock
+        if self.lock_depth == 0:
+            try:
+                import fcntl
+
+                fcntl.flock(self.file_descriptor, fcntl.LOCK_EX)
+            except ImportError:
+                # No locks between processes on this platform
+                pass
+
+        self.lock_depth = self.lock_depth + 1
+
+    def unlock(self):
+        self.lock_depth = self.lock_depth - 1
+        if self.lock_depth > 0:
+            return
+
+        try:
+            import fcntl
+        except ImportError:
+            return
+
+        fcntl.flock(self.file_descriptor, fcntl.LOCK_UN)
+
+    def generation(self):
+        import struct
+
+        return struct.unpack_from(self.layout, self.memory)[1]
+
+    def get_log_stat(self):
+        import os
+
+        try:
+            stat = os.stat(self.json_database)
+        except FileNotFoundError:
+            return 0, 0
+
+        return stat.st_size, stat.st_mtime_ns
+
+    def bump(self):
+        import struct
+
+        struct.pack_into(self.layout, self.memory, 0, self.magic, self.generation() + 1, *self.get_log_stat())
+
+    @contextmanager
+    def changing(self):
+        # Around a change of the log: one writer at a time, and the generation is
+        # bumped once the change is on disk
+        self.check_process()
+        self.lock()
+        try:
+            yield
+        finally:
+            self.bump()
+            self.unlock()
+
+    def log_changed(self):
+        # The log is not the one of the last change: edited or replaced out of band
+        import struct
+
+        return struct.unpack_from(self.layout, self.memory)[2:] != self.get_log_stat()
+
+    def check_log(self):
+        import struct
+
+        self.check_process()
+        self.lock()
+        try:
+            if struct.unpack_from(self.layout, self.memory)[2:] != self.get_log_stat():
+                self.bump()
+        finally:
+            self.unlock()
+
+
+class ImageCatalog:
+    # Long-lived, in-memory view of the images database. The JSONL file is read
+    # once and then tailed from the last byte offset, so appended records are
+    # picked up without parsing the whole file again.
+    catalogs = {}
+    catalogs_lock = threading.Lock()
+
+    def __init__(self, json_database, state_file=None):
+        self.json_database = json_database
+        self.lock = threading.RLock()
+        # Generation of the records: bumped on every change, never reset
+        self.version = 0
+        # Shared generation of the log, and the one loaded
+        self.state = SharedCatalogState(state_file, json_database) if state_file else None
+        self.state_generation = None
+        self.reset()
+
+    @staticmethod
+    def instance(json_database, state_file=None):
+        with ImageCatalog.catalogs_lock:
+            if json_database not in ImageCatalog.catalogs:
+                ImageCatalog.catalogs[json_database] = ImageCatalog(json_database, state_file)
+            return ImageCatalog.catalogs[json_database]
+
+    def reset(self):
+        with self.lock:
+            self.records = {}
+            self.sort_keys = {}
+            # hex_digest -> (unknown title, empty description) upgrade flags
+            self.upgrade_flags = {}
+            self.token_index = TokenIndex()
+            # (field, value) -> sort keys in ascending order, for country, folder and id-new
+            self.groups = {}
+            self.search_cache = OrderedDict()
+            self.version = self.version + 1
+            # Lines read from the log, superseded records included
+            self.rows = 0
+            # (timestamp, hex_digest) tuples in ascending order, newest at the end
+            self.order = []
+            self.offset = 0
+            self.identity = None
+            self.mtime = None
+            self.state_generation = None
+
+    def invalidate(self):
+        self.reset()
+
+    def changing(self):
+        from contextlib import nullcontext
+
+        return self.state.changing() if self.state else nullcontext()
+
+    def refresh(self):
+        # Nothing to look at while the shared generation is the one loaded
+        with self.lock:
+            generation = self.state.generation() if self.state else None
+            if generation is not None and generation == self.state_generation:
+                if not self.state.log_changed():
+                    return
+                # Changed without a bump, the other processes see it too
+                self.state.check_log()
+                generation = self.state.generation()
+
+            self.refresh_log()
+            self.state_generation = generation
+
+    def refresh_log(self):
+        import os
+
+        with self.lock:
+            try:
+                stat = os.stat(self.json_database)
+            except FileNotFoundError:
+                if self.identity is not None:
+                    self.reset()
+                return
+
+            identity = (stat.st_dev, stat.st_ino)
+            if identity != self.identity or stat.st_size < self.offset:
+                self.reset()
+                self.identity = identity
+
+            elif stat.st_size == self.offset:
+                if stat.st_mtime_ns != self.mtime:
+                    # Same size but rewritten in place, nothing can be trusted
+                    self.reset()
+                    self.identity = identity
+                else:
+                    return
+
+            self.read_from_offset()
+            self.mtime = stat.st_mtime_ns
+
+    def read_from_offset(self):
+        with open(self.json_database, 'rb') as file:
+            if self.offset > 0:
+                file.seek(self.offset - 1)
+                if file.read(1) != b"\n":
+                    # The file was not appended to, it was replaced
+                    identity = self.identity
+                    self.reset()
+                    self.identity = identity
+                    file.seek(0)
+
+            data = file.read()
+
+        # Ignore a trailing partial line, it will be read once it is complete
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return
+
+        for line in data[:end].splitlines():
+            if line.strip():
+                self.add_record(self.parse_record(line))
+                self.rows = self.rows + 1
+
+        self.offset = self.offset + end
+
+    @staticmethod
+    def parse_record(line):
+        import json
+        from utils import AppConfig
+
+        json_line = json.loads(line)
+
+        if 'description' not in json_line:
+            json_line['description'] = ""
+
+        if 'country' not in json_line:
+            json_line['country'] = "Unknown"
+
+        if 'country_name' not in json_line:
+            json_line['country_name'] = AppConfig.get_country_name(json_line['country'])
+
+        return json_line
+
+    @staticmethod
+    def get_sort_key(json_line):
+        from datetime import datetime
+
+        # Normalized ISO strings sort chronologically and compare faster than datetimes
+        timestamp = datetime.fromisoformat(json_line['timestamp']).isoformat(timespec='microseconds')
+        return timestamp, json_line['hex_digest']
+
+    def add_record(self, json_line):
+        from bisect import insort
+
+        hex_digest = json_line['hex_digest']
+        self.remove_record(hex_digest)
+
+        key = self.get_sort_key(json_line)
+        self.records[hex_digest] = json_line
+        self.sort_keys[hex_digest] = key
+        self.upgrade_flags[hex_digest] = (json_line['title'] == "Unknown", json_line['description'] == "")
+        self.token_index.add(hex_digest, json_line)
+        self.version = self.version + 1
+
+        for keys in [self.order] + [self.groups.setdefault(group, []) for group in self.get_groups(json_line)]:
+            if not keys or keys[-1] < key:
+                keys.append(key)
+            else:
+                insort(keys, key)
+
+    def remove_record(self, hex_digest):
+        from bisect import bisect_left
+
+        if hex_digest in self.records:
+            key = self.sort_keys[hex_digest]
+            del self.order[bisect_left(self.order, key)]
+            for group in self.get_groups(self.records[hex_digest]):
+                keys = self.groups[group]
+                del keys[bisect_left(keys, key)]
+                if not keys:
+                    del self.groups[group]
+            del self.records[hex_digest]
+            del self.sort_keys[hex_digest]
+            del self.upgrade_flags[hex_digest]
+            self.token_index.remove(hex_digest)
+            self.version = self.version + 1
+
+    @staticmethod
+    def get_folder(json_line):
+        # Top level folder of the output dir the image is saved into
+        image_path = json_line.get('image_path', "")
+        return image_path.split("/")[0] if "/" in image_path else None
+
+    @staticmethod
+    def get_groups(json_line):
+        groups = [('country', json_line['country'].upper())]
+
+        folder = ImageCatalog.get_folder(json_line)
+        if folder is not None:
+            groups.append(('folder', folder))
+
+        if json_line.get('id-new'):
+            groups.append(('id-new', json_line['id-new']))
+
+        return groups
+
+    def facets(self):
+        # folder -> (images, timestamp of the latest image)
+        with self.lock:
+            self.refresh()
+            return {value: (len(keys), keys[-1][0])
+                    for (field, value), keys in self.groups.items() if field == 'folder'}
+
+    def dead_ratio(self):
+        with self.lock:
+            self.refresh()
+            return 1 - len(self.records) / self.rows if self.rows else 0
+
+    def compact(self, drop=()):
+        # Rewrite the log with one row per digest: a single buffered write to a
+        # temp file in the same directory, then an atomic rename over the log
+        import json
+        import os
+
+        # Under the shared lock, no other process appends between the read and the rename
+        with self.lock, self.changing():
+            self.refresh()
+            for hex_digest in drop:
+                self.remove_record(hex_digest)
+
+            bytes_before = os.path.getsize(self.json_database) if os.path.exists(self.json_database) else 0
+            temp_file = f"{self.json_database}.tmp"
+
+            with open(temp_file, 'w') as file:
+                file.write("".join(json.dumps(self.records[key[1]]) + "\n" for key in self.order))
+                file.flush()
+                os.fsync(file.fileno())
+
+            os.replace(temp_file, self.json_database)
+
+            stat = os.stat(self.json_database)
+            self.identity = (stat.st_dev, stat.st_ino)
+            self.offset = stat.st_size
+            self.mtime = stat.st_mtime_ns
+            self.rows = len(self.records)
+
+            return bytes_before, stat.st_size
+
+    def images(self):
+        with self.lock:
+            self.refresh()
+            return [self.records[key[1]] for key in reversed(self.order)]
+
+    def get(self, hex_digest):
+        with self.lock:
+            self.refresh()
+            return self.records.get(hex_digest)
+
+    def lookup(self, hex_digest):
+        with self.lock:
+            self.refresh()
+            return self.records.get(hex_digest), self.upgrade_flags.get(hex_digest, (False, False))
+
+    def count(self):
+        with self.lock:
+            self.refresh()
+            return len(self.records)
+
+    def generation(self):
+        with self.lock:
+            self.refresh()
+            return self.state_generation if self.state else self.version
+
+    def images_at(self, positions):
+        # Records at these positions of the catalog order (oldest first)
+        with self.lock:
+            self.refresh()
+            return [self.records[self.order[position][1]] for position in positions if position < len(self.order)]
+
+    def add(self, json_image):
+        import json
+
+        with self.lock, self.changing():
+            with open(self.json_database, 'a') as file:
+                file.write(json.dumps(json_image) + "\n")
+
+    def add_all(self, json_images):
+        import json
+
+        if not json_images:
+            return
+
+        with self.lock, self.changing():
+            with open(self.json_database, 'a') as file:
+                file.write("".join(json.dumps(json_image) + "\n" for json_image in json_images))
+
+    def clear(self):
+        import os
+
+        with self.lock, self.changing():
+            if os.path.exists(self.json_database):
+                os.remove(self.json_database)
+            self.reset()
+
+    def search_digests(self, search_term):
+        # /search asks for the count and then a page of the same term, keep recent results
+        cached = self.search_cache.get(search_term)
+        if cached and cached['version'] == self.version:
+            self.search_cache.move_to_end(search_term)
+            return cached
+
+        cached = {'version': self.version, 'digests': self.token_index.search(search_term), 'keys': None}
+        self.search_cache[search_term] = cached
+        if len(self.search_cache) > 64:
+            self.search_cache.popitem(last=False)
+
+        return cached
+
+    def search(self, search_term, limit=None, offset=0):
+        from itertools import islice
+
+        with self.lock:
+            self.refresh()
+            cached = self.search_digests(search_term)
+            digests = cached['digests']
+            end = None if limit is None else offset + limit
+
+            if cached['keys'] is None:
+                # Walking the timestamp order is cheaper than sorting while the
+                # page is found after a few matches
+                if digests is None or end is not None and end * len(self.order) < len(digests) ** 2:
+                    keys = (key for key in reversed(self.order) if digests is None or key[1] in digests)
+                    return [self.records[key[1]] for key in islice(keys, offset, end)]
+
+            keys = self.get_search_keys(cached)
+            start = 0 if end is None else max(len(keys) - end, 0)
+            return [self.records[key[1]] for key in reversed(keys[start:max(len(keys) - offset, 0)])]
+
+    def get_search_keys(self, cached):
+        # Sort keys of the matches in ascending order, sorted once per catalog version
+        if cached['digests'] is None:
+            return self.order
+
+        if cached['keys'] is None:
+            cached['keys'] = sorted([self.sort_keys[digest] for digest in cached['digests']])
+
+        return cached['keys']
+
+    def get_keys(self, field=None, value=None):
+        if field is None:
+            return self.order
+
+        if field == 'search':
+            return self.get_search_keys(self.search_digests(value))
+
+        if field == 'country':
+            value = value.upper()
+
+        return self.groups.get((field, value), [])
+
+    def page(self, field=None, value=None, limit=20, before=None, offset=0):
+        # Newest first: the images (optionally of a field value) older than the
+        # sort key `before` (keyset pagination), or after skipping `offset` of
+        # them. Binary search and slicing, the cost only depends on the limit.
+        # Returns the images and the key to ask for the next page, if any.
+        from bisect import bisect_left
+
+        with self.lock:
+            self.refresh()
+            keys = self.get_keys(field, value)
+
+            end = len(keys) if before is None else bisect_left(keys, tuple(before))
+            end = max(end - offset, 0)
+            start = max(end - limit, 0)
+
+            page = keys[start:end][::-1]
+            return [self.records[key[1]] for key in page], page[-1] if start > 0 and page else None
+
+    def page_count(self, field=None, value=None):
+        with self.lock:
+            self.refresh()
+            return len(self.get_keys(field, value))
+
+    def search_count(self, search_term):
+        with self.lock:
+            self.refresh()
+            digests = self.search_digests(search_term)['digests']
+            return len(self.records) if digests is None else len(digests)
+
+    def search_id(self, id_new):
+        # Exact id, as /new and the SQLite catalog
+        with self.lock:
+            self.refresh()
+            return [self.records[key[1]] for key in reversed(self.groups.get(('id-new', id_new), []))]
+
+    def clear_search_cache(self):
+        with self.lock:
+            self.search_cache.clear()
+
+    def export_jsonl(self, json_database):
+        import json
+        import os
+
+        with self.lock:
+            self.refresh()
+            if os.path.abspath(json_database) == os.path.abspath(self.json_database):
+                return
+
+            with open(json_database, 'w') as file:
+                file.write("".join(json.dumps(self.records[key[1]]) + "\n" for key in self.order))
+
+
+class SqliteImageCatalog:
+    # SQLite storage backend (WAL mode) with the same interface as ImageCatalog.
+    # Records are stored as JSON next to indexed columns, and an FTS5 table over
+    # title/description/copyright serves the searches.
+    catalogs = {}
+    catalogs_lock = threading.Lock()
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY,
+            hex_digest TEXT NOT NULL UNIQUE,
+            timestamp TEXT NOT NULL,
+            id_new TEXT NOT NULL DEFAULT '',
+            title TEXT NOT NULL DEFAULT '',
+            description TEXT NOT NULL DEFAULT '',
+            copyright TEXT NOT NULL DEFAULT '',
+            folder TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS images_order ON images (timestamp, hex_digest);
+        CREATE INDEX IF NOT EXISTS images_id_new_order ON images (id_new, timestamp, hex_digest);
+        CREATE INDEX IF NOT EXISTS images_folder_order ON images (folder, timestamp, hex_digest);
+        CREATE INDEX IF NOT EXISTS images_country_order ON images (upper(json_extract(data, '$.country')), timestamp,
+                                                                   hex_digest);
+        CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5 (
+            title, description, copyright, content='images', content_rowid='id'
+        );
+        CREATE TRIGGER IF NOT EXISTS images_ai AFTER INSERT ON images BEGIN
+            INSERT INTO images_fts (rowid, title, description, copyright)
+            VALUES (new.id, new.title, new.description, new.copyright);
+        END;
+        CREATE TRIGGER IF NOT EXISTS images_ad AFTER DELETE ON images BEGIN
+            INSERT INTO images_fts (images_fts, rowid, title, description, copyright)
+            VALUES ('delete', old.id, old.title, old.description, old.copyright);
+        END;
+        CREATE TRIGGER IF NOT EXISTS images_au AFTER UPDATE ON images BEGIN
+            INSERT INTO images_fts (images_fts, rowid, title, description, copyright)
+            VALUES ('delete', old.id, old.title, old.description, old.copyright);
+            INSERT INTO images_fts (rowid, title, description, copyright)
+            VALUES (new.id, new.title, new.description, new.copyright);
+        END;
+        CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, images INTEGER NOT NULL, latest TEXT NOT NULL);
+        CREATE TRIGGER IF NOT EXISTS folders_ai AFTER INSERT ON images BEGIN
+            INSERT INTO folders (folder, images, latest) SELECT new.folder, 1, new.timestamp WHERE new.folder IS NOT NULL
+            ON CONFLICT (folder) DO UPDATE SET images = images + 1, latest = max(latest, excluded.latest);
+        END;
+        CREATE TRIGGER IF NOT EXISTS folders_ad AFTER DELETE ON images BEGIN
+            UPDATE folders SET images = images - 1,
+                latest = coalesce((SELECT max(timestamp) FROM images WHERE folder = old.folder), latest)
+            WHERE folder = old.folder;
+            DELETE FROM folders WHERE folder = old.folder AND images <= 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS folders_au AFTER UPDATE OF folder, timestamp ON images BEGIN
+            UPDATE folders SET images = images - 1,
+                latest = coalesce((SELECT max(timestamp) FROM images WHERE folder = old.folder), latest)
+            WHERE folder = old.folder;
+            DELETE FROM folders WHERE folder = old.folder AND images <= 0;
+            INSERT INTO folders (folder, images, latest) SELECT new.folder, 1, new.timestamp WHERE new.folder IS NOT NULL
+            ON CONFLICT (folder) DO UPDATE SET images = images + 1, latest = max(latest, excluded.latest);
+        END;
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+        CREATE TRIGGER IF NOT EXISTS generation_ai AFTER INSERT ON images BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'generation';
+        END;
+        CREATE TRIGGER IF NOT EXISTS generation_ad AFTER DELETE ON images BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'generation';
+        END;
+        CREATE TRIGGER IF NOT EXISTS generation_au AFTER UPDATE ON images BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'generation';
+        END;
+    """
+
+    # PRAGMA user_version of a database with the schema above
+    schema_version = 1
+
+    def __init__(self, sqlite_database, json_database):
+        self.sqlite_database = sqlite_database
+        self.json_database = json_database
+        self.local = threading.local()
+        # (generation, ids in the catalog order) for images_at()
+        self.ordered_ids = (None, None)
+        self.migrate_jsonl()
+
+    @staticmethod
+    def instance(sqlite_database, json_database):
+        with SqliteImageCatalog.catalogs_lock:
+            if sqlite_database not in SqliteImageCatalog.catalogs:
+                SqliteImageCatalog.catalogs[sqlite_database] = SqliteImageCatalog(sqlite_database, json_database)
+            return SqliteImageCatalog.catalogs[sqlite_database]
+
+    def connection(self):
+        import os
+        import sqlite3
+
+        # One connection per thread and per process, connections must not cross a fork
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.sqlite_database, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.upgrade_schema(connection)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+
+        return self.local.connection
+
+    @classmethod
+    def upgrade_schema(cls, connection):
+        # The schema is created or upgraded once per database, not on every connection
+        if connection.execute("PRAGMA user_version").fetchone()[0] >= cls.schema_version:
+            return
+
+        cls.upgrade_folders(connection)
+        # Indexes replaced by the ones ending with the catalog order
+        connection.executescript(f"""
+            BEGIN IMMEDIATE;
+            DROP INDEX IF EXISTS images_timestamp;
+            DROP INDEX IF EXISTS images_id_new;
+            DROP INDEX IF EXISTS images_folder;
+            {cls.schema}
+            PRAGMA user_version = {cls.schema_version};
+            COMMIT;
+        """)
+
+    @staticmethod
+    def upgrade_folders(connection):
+        # Databases created before the folder facets need the folder column and counters
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(images)")]
+        if not columns or 'folder' in columns:
+            return
+
+        folder = "json_extract(data, '$.image_path')"
+        with connection:
+            connection.execute("ALTER TABLE images ADD COLUMN folder TEXT")
+            connection.execute(f"UPDATE images SET folder = CASE WHEN instr({folder}, '/') > 0 "
+                               f"THEN substr({folder}, 1, instr({folder}, '/') - 1) END")
+            connection.execute("CREATE TABLE folders (folder TEXT PRIMARY KEY, images INTEGER NOT NULL, "
+                               "latest TEXT NOT NULL)")
+            connection.execute("INSERT INTO folders SELECT folder, count(*), max(timestamp) FROM images "
+                               "WHERE folder IS NOT NULL GROUP BY folder")
+
+    def migrate_jsonl(self):
+        import logging
+        import os
+
+        logger = logging.getLogger("migrate_jsonl")
+        connection = self.connection()
+
+        if connection.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+            return
+
+        images = []
+        if os.path.isfile(self.json_database):
+            logger.info(f"Migrating {self.json_database} to {self.sqlite_database} ...")
+            images = ImageCatalog(self.json_database).images()
+
+        with connection:
+            connection.executemany(self.upsert_sql, [self.to_row(image) for image in reversed(images)])
+            connection.execute("INSERT INTO meta (key, value) VALUES ('migrated', datetime('now'))")
+
+        logger.info(f"{len(images)} images migrated to {self.sqlite_database}")
+
+    upsert_sql = """
+        INSERT INTO images (hex_digest, timestamp, id_new, title, description, copyright, folder, data)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (hex_digest) DO UPDATE SET
+            timestamp = excluded.timestamp, id_new = excluded.id_new, title = excluded.title,
+            description = excluded.description, copyright = excluded.copyright, folder = excluded.folder,
+            data = excluded.data
+    """
+
+    @staticmethod
+    def to_row(json_image):
+        import json
+
+        json_image = ImageCatalog.parse_record(json.dumps(json_image))
+        return (json_image['hex_digest'], json_image['timestamp'], json_image.get('id-new', ""),
+                json_image['title'], json_image['description'], json_image.get('copyright', ""),
+                ImageCatalog.get_folder(json_image), json.dumps(json_image))
+
+    def query(self, sql, parameters=()):
+        import json
+
+        return [json.loads(row[0]) for row in self.connection().execute(sql, parameters)]
+
+    def refresh(self):
+        pass
+
+    def invalidate(self):
+        pass
+
+    def images(self):
+        return self.query("SELECT data FROM images ORDER BY timestamp DESC")
+
+    def get(self, hex_digest):
+        images = self.query("SELECT data FROM images WHERE hex_digest = ?", (hex_digest,))
+        return images[0] if images else None
+
+    def lookup(self, hex_digest):
+        image = self.get(hex_digest)
+        if image is None:
+            return None, (False, False)
+        return image, (image['title'] == "Unknown", image['description'] == "")
+
+    def count(self):
+        return self.connection().execute("SELECT count(*) FROM images").fetchone()[0]
+
+    def generation(self):
+        # Bumped by the triggers on every change, shared by all the processes
+        return int(self.connection().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+
+    def images_at(self, positions):
+        # The ids in the catalog order are read from the index once per generation
+        import json
+        from array import array
+
+        generation = self.generation()
+        ids_generation, ids = self.ordered_ids
+        if ids_generation != generation:
+            ids = array('q', (row[0] for row in
+                              self.connection().execute("SELECT id FROM images ORDER BY timestamp, hex_digest")))
+            self.ordered_ids = (generation, ids)
+
+        selected = [ids[position] for position in positions if position < len(ids)]
+        rows = dict(self.connection().execute(
+            f"SELECT id, data FROM images WHERE id IN ({', '.join('?' * len(selected))})", selected))
+        return [json.loads(rows[image_id]) for image_id in selected if image_id in rows]
+
+    def facets(self):
+        return {folder: (images, latest)
+                for folder, images, latest in self.connection().execute("SELECT folder, images, latest FROM folders")}
+
+    def add(self, json_image):
+        with self.connection() as connection:
+            connection.execute(self.upsert_sql, self.to_row(json_image))
+
+    def add_all(self, json_images):
+        with self.connection() as connection:
+            connection.executemany(self.upsert_sql, [self.to_row(json_image) for json_image in json_images])
+
+    def clear(self):
+        with self.connection() as connection:
+            connection.execute("DELETE FROM images")
+
+    def dead_ratio(self):
+        return 0
+
+    def compact(self, drop=()):
+        import os
+
+        bytes_before = os.path.getsize(self.sqlite_database)
+        with self.connection() as connection:
+            connection.executemany("DELETE FROM images WHERE hex_digest = ?", [(digest,) for digest in drop])
+
+        return bytes_before, os.path.getsize(self.sqlite_database)
+
+    @staticmethod
+    def search_condition(search_term):
+        # Every word must match a title/description/copyright prefix, or the
+        # whole term must be a prefix of the digest or the timestamp
+        words = [word for word in search_term.replace('"', ' ').split() if word]
+        fts_query = " AND ".join(f'"{word}"*' for word in words) or '""'
+        term = search_term.strip().lower()
+
+        condition = """
+            (id IN (SELECT rowid FROM images_fts WHERE images_fts MATCH ?)
+             OR (hex_digest >= ? AND hex_digest < ?)
+             OR (timestamp >= ? AND timestamp < ?))
+        """
+        return condition, (fts_query, term, term + "\uffff", term, term + "\uffff")
+
+    def search(self, search_term, limit=None, offset=0):
+        condition, parameters = self.search_condition(search_term)
+        return self.query(f"SELECT data FROM images WHERE {condition} ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+                          parameters + (-1 if limit is None else limit, offset))
+
+    def search_count(self, search_term):
+        condition, parameters = self.search_condition(search_term)
+        return self.connection().execute(f"SELECT count(*) FROM images WHERE {condition}", parameters).fetchone()[0]
+
+    def search_id(self, id_new):
+        return self.query("SELECT data FROM images WHERE id_new = ? ORDER BY timestamp DESC", (id_new,))
+
+    def clear_search_cache(self):
+        # Searches are not cached, FTS5 answers each one
+        pass
+
+    def page_condition(self, field=None, value=None):
+        if field is None:
+            return "1", ()
+        if field == 'search':
+            return self.search_condition(value)
+        if field == 'country':
+            return "upper(json_extract(data, '$.country')) = ?", (value.upper(),)
+        if field == 'folder':
+            return "folder = ?", (value,)
+        if field == 'id-new':
+            return "id_new = ?", (value,)
+
+        raise ValueError(f"Unknown field {field}")
+
+    def page(self, field=None, value=None, limit=20, before=None, offset=0):
+        # Same as ImageCatalog.page(), on the (timestamp, hex_digest) indexes
+        import json
+
+        condition, parameters = self.page_condition(field, value)
+        if before is not None:
+            condition = f"{condition} AND (timestamp, hex_digest) < (?, ?)"
+            parameters = parameters + tuple(before)
+
+        rows = self.connection().execute(
+            f"SELECT data, timestamp, hex_digest FROM images WHERE {condition} "
+            f"ORDER BY timestamp DESC, hex_digest DESC LIMIT ? OFFSET ?", parameters + (limit + 1, offset)).fetchall()
+
+        next_key = (rows[limit - 1][1], rows[limit - 1][2]) if len(rows) > limit else None
+        return [json.loads(row[0]) for row in rows[:limit]], next_key
+
+    def page_count(self, field=None, value=None):
+        condition, parameters = self.page_condition(field, value)
+        return self.connection().execute(f"SELECT count(*) FROM images WHERE {condition}", parameters).fetchone()[0]
+
+    def export_jsonl(self, json_database):
+        import os
+
+        temp_file = f"{json_database}.tmp"
+        with open(temp_file, 'w') as file:
+            for (data,) in self.connection().execute("SELECT data FROM images ORDER BY timestamp"):
+                file.write(data + "\n")
+
+        os.replace(temp_file, json_database)
+
+
+class SeenUrlIndex:
+    # Maps Spotlight image URLs, and their stable asset id (the URL without the
+    # query string), to the hex_digest of the bytes they served, so repeated
+    # items are recognised before downloading them. It is rebuilt from the
+    # database records and the appends persisted in its own JSONL file.
+
+    def __init__(self, index_file, images=()):
+        self.index_file = index_file
+        self.urls = {}
+        # asset id -> (hex_digest, ETag)
+        self.assets = {}
+        # Digests rejected as near duplicates, never stored but not downloaded again
+        self.rejected = set()
+
+        for image in images:
+            url = image.get('image_url_landscape', "")
+            if url.startswith("http"):
+                self.remember(url, image['hex_digest'], None)
+
+        self.read_index_file()
+
+    @staticmethod
+    def get_asset_id(url):
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        return f"{parts.netloc}{parts.path}"
+
+    def read_index_file(self):
+        import json
+        import os
+
+        if not os.path.isfile(self.index_file):
+            return
+
+        with open(self.index_file, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.remember(entry['url'], entry['hex_digest'], entry.get('etag'), entry.get('rejected', False))
+
+    def remember(self, url, hex_digest, etag, rejected=False):
+        self.urls[url] = hex_digest
+        if rejected:
+            self.rejected.add(hex_digest)
+
+        asset_id = self.get_asset_id(url)
+        if etag is None and self.assets.get(asset_id, (None, None))[0] == hex_digest:
+            etag = self.assets[asset_id][1]
+        self.assets[asset_id] = (hex_digest, etag)
+
+    def get(self, url):
+        return self.urls.get(url)
+
+    def get_asset(self, url):
+        return self.assets.get(self.get_asset_id(url), (None, None))
+
+    def is_rejected(self, hex_digest):
+        return hex_digest in self.rejected
+
+    def add(self, url, hex_digest, etag=None, rejected=False):
+        import json
+
+        if self.urls.get(url) == hex_digest and (etag is None or self.get_asset(url)[1] == etag) and \
+                rejected == self.is_rejected(hex_digest):
+            return
+
+        self.remember(url, hex_digest, etag, rejected)
+        entry = {'url': url, 'hex_digest': hex_digest, 'etag': etag}
+        if rejected:
+            entry['rejected'] = True
+        with open(self.index_file, 'a') as file:
+            file.write(json.dumps(entry) + "\n")
@@ -1,21 +1,228 @@
-import cv2
+import logging
+
+from utils import *
+
+THUMBNAIL_SIZE = 32
+
+
+def get_thumbnail(image_full_path):
+    # Every image is decoded once into a 32x32 grayscale thumbnail (JPEGs at
+    # reduced scale through PIL draft)
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(image_full_path) as picture:
+        picture.draft('L', (THUMBNAIL_SIZE * 2, THUMBNAIL_SIZE * 2))
+        thumbnail = picture.convert('L').resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+
+    return np.asarray(thumbnail, dtype=np.uint8).reshape(-1)
+
+
+def normalize(thumbnails):
+    # Rows with zero mean and unit norm: the dot product of two rows is the
+    # correlation of the thumbnails, so brightness and contrast changes do not count
+    import numpy as np
+
+    rows = thumbnails.astype(np.float32)
+    rows -= rows.mean(axis=1, keepdims=True)
+    rows /= np.maximum(np.linalg.norm(rows, axis=1, keepdims=True), 1e-6)
+    return rows
+
 
 def compare_images(image1_path, image2_path):
-    image1 = cv2.imread(image1_path)
-    image2 = cv2.imread(image2_path)
+    import numpy as np
+
+    image1, image2 = normalize(np.stack([get_thumbnail(image1_path), get_thumbnail(image2_path)]))
+    return float(image1 @ image2)
+
+
+class SimilarityIndex:
+    # Thumbnails of the library in a memory-mapped .npy matrix (one row per
+    # image) next to the database, and a state file with the digest of every
+    # row, the rows already scanned and the similar pairs found. New images are
+    # appended and only compared against the rest, nothing is recomputed.
+
+    def __init__(self):
+        self.logger = logging.getLogger("similarity")
+        self.thumbnails_name = f"{AppConfig.get_output_dir()}/{AppConfig.get_similarity_thumbnails_filename()}"
+        self.state_name = f"{AppConfig.get_output_dir()}/{AppConfig.get_similarity_state_filename()}"
+        self.state = self.read_state()
+
+    def read_state(self):
+        import json
+        import numpy as np
+        import os
+
+        state = {'digests': [], 'scanned': 0, 'threshold': None, 'pairs': []}
+        if not os.path.isfile(self.state_name) or not os.path.isfile(self.thumbnails_name):
+            return state
+
+        try:
+            with open(self.state_name, 'r') as file:
+                saved_state = json.load(file)
+        except ValueError:
+            return state
+
+        # An update interrupted between the matrix and the state file starts over
+        if len(np.load(self.thumbnails_name, mmap_mode='r')) == len(saved_state['digests']):
+            state.update(saved_state)
+
+        return state
+
+    def save_state(self):
+        import json
+        import os
+
+        with open(f"{self.state_name}.tmp", 'w') as file:
+            json.dump(self.state, file)
+
+        os.replace(f"{self.state_name}.tmp", self.state_name)
+
+    def load_thumbnails(self):
+        import numpy as np
+        import os
+
+        if not self.state['digests'] or not os.path.isfile(self.thumbnails_name):
+            return np.zeros((0, THUMBNAIL_SIZE * THUMBNAIL_SIZE), dtype=np.uint8)
+
+        return np.load(self.thumbnails_name, mmap_mode='r')
+
+    def update_thumbnails(self):
+        # Decodes the images not in the matrix yet and appends their rows
+        import numpy as np
+        import os
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        start = time.perf_counter()
+        known = set(self.state['digests'])
+        new_images = [json_image for json_image in reversed(read_images_database())
+                      if json_image['hex_digest'] not in known and
+                      os.path.isfile(f"{AppConfig.get_output_dir()}/{json_image['image_path']}")]
+
+        if not new_images:
+            return 0
+
+        def get_image_thumbnail(json_image):
+            try:
+                return get_thumbnail(f"{AppConfig.get_output_dir()}/{json_image['image_path']}")
+            except BaseException as error:
+                self.logger.error(f"Error reading {json_image['image_path']}: {error}")
+                return None
+
+        with ThreadPoolExecutor() as executor:
+            thumbnails = list(executor.map(get_image_thumbnail, new_images))
+
+        digests = [json_image['hex_digest'] for json_image, thumbnail in zip(new_images, thumbnails)
+                   if thumbnail is not None]
+        thumbnails = [thumbnail for thumbnail in thumbnails if thumbnail is not None]
+        if not thumbnails:
+            return 0
+
+        old_thumbnails = self.load_thumbnails()
+        rows = len(old_thumbnails)
+
+        temp_name = f"{self.thumbnails_name}.tmp"
+        matrix = np.lib.format.open_memmap(temp_name, mode='w+', dtype=np.uint8,
+                                           shape=(rows + len(thumbnails), THUMBNAIL_SIZE * THUMBNAIL_SIZE))
+        matrix[:rows] = old_thumbnails
+        matrix[rows:] = np.stack(thumbnails)
+        matrix.flush()
+        del matrix, old_thumbnails
+
+        os.replace(temp_name, self.thumbnails_name)
+        self.state['digests'] = self.state['digests'] + digests
+        self.save_state()
+
+        self.logger.info(f"{len(digests)} thumbnails added in {time.perf_counter() - start:.2f} s")
+        return len(digests)
+
+    def scan(self, threshold, full=False):
+        # Compares the rows not scanned yet against all the previous ones, one
+        # block of rows against one block of columns at a time
+        import numpy as np
+        import time
+
+        if full or self.state['threshold'] != threshold:
+            self.state.update({'scanned': 0, 'threshold': threshold, 'pairs': []})
+
+        start = time.perf_counter()
+        thumbnails = self.load_thumbnails()
+        digests = self.state['digests']
+        block_size = AppConfig.get_similarity_block_size()
+        first_row = self.state['scanned']
+        pairs = []
+
+        for row_start in range(first_row, len(thumbnails), block_size):
+            rows = normalize(thumbnails[row_start:row_start + block_size])
+            row_end = row_start + len(rows)
+
+            for column_start in range(0, row_end, block_size):
+                columns = normalize(thumbnails[column_start:min(column_start + block_size, row_end)])
+                scores = rows @ columns.T
+
+                for row, column in zip(*np.nonzero(scores >= threshold)):
+                    if column_start + column < row_start + row:
+                        pairs.append([digests[column_start + column], digests[row_start + row],
+                                      round(float(scores[row, column]), 4)])
+
+        self.state['pairs'] = self.state['pairs'] + pairs
+        self.state['scanned'] = len(thumbnails)
+        self.save_state()
+
+        self.logger.info(f"{len(thumbnails) - first_row} new images compared against {len(thumbnails)} in "
+                         f"{time.perf_counter() - start:.2f} s, {len(pairs)} new similar pairs")
+
+    def groups(self):
+        # Connected components of the similar pairs, of the images still in the library
+        catalog = get_image_catalog()
+        parents = {}
+
+        def find(hex_digest):
+            root = parents.setdefault(hex_digest, hex_digest)
+            while root != parents[root]:
+                root = parents[root]
+            parents[hex_digest] = root
+            return root
+
+        for hex_digest1, hex_digest2, _ in self.state['pairs']:
+            if catalog.get(hex_digest1) is not None and catalog.get(hex_digest2) is not None:
+                parents[find(hex_digest1)] = find(hex_digest2)
+
+        groups = {}
+        for hex_digest in parents:
+            groups.setdefault(find(hex_digest), []).append(hex_digest)
+
+        return sorted(groups.values(), key=len, reverse=True)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Groups of similar images in the library")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="Minimum correlation of the thumbnails (default similarity.threshold)")
+    parser.add_argument("--full", action="store_true", help="Compare all the images again")
+    args = parser.parse_args()
+
+    init_configuration()
+    conf_logging()
+    logger = logging.getLogger("compare")
+
+    threshold = args.threshold if args.threshold is not None else AppConfig.get_similarity_threshold()
+
+    index = SimilarityIndex()
+    index.update_thumbnails()
+    index.scan(threshold, args.full)
 
-    diff = cv2.absdiff(image1, image2)
-    gray = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-    _, threshold = cv2.threshold(gray, 30, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(threshold, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    similarity = 1.0 - (len(contours) / 5000.0)
-    return similarity
+    groups = index.groups()
+    for group in groups:
+        logger.info(f"{len(group)} similar images:")
+        for hex_digest in group:
+            logger.info(f"  {hex_digest} {get_image_catalog().get(hex_digest)['image_path']}")
 
+    logger.info(f"{len(groups)} groups of similar images")
 
-# Ruta de las imágenes a comparar
-image1_path = 'c:/tmp/f0475b4709bad02e5392fb0295ae1ff8.jpg'
-image2_path = 'c:/tmp/images/Unknown/ee20c85d15b2f05dfc1dc527169aefee.jpg'
 
-# Comparar las imágenes
-similarity = compare_images(image1_path, image2_path)
-print(f"Probabilidad de similitud: {similarity}")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import logging
+
+from utils import *
+
+
+def get_perceptual_hash(image):
+    # 64 bit dHash: 9x8 grayscale thumbnail, one bit per pair of horizontal
+    # neighbours. Survives re-compression, resizing and small crops.
+    from PIL import Image
+
+    with Image.open(image) as picture:
+        # JPEGs are decoded at a reduced scale, no need for the full image
+        picture.draft('L', (72, 64))
+        pixels = list(picture.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = value << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+
+    return f"{value:016x}"
+
+
+def hamming_distance(hash1, hash2):
+    return bin(int(hash1, 16) ^ int(hash2, 16)).count("1")
+
+
+class BKTree:
+    # Metric tree on the Hamming distance: a query within distance d only visits
+    # the children whose edge is within d of the distance to the node
+
+    def __init__(self):
+        # node = [hash, digests, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def add(self, image_hash, hex_digest):
+        self.size = self.size + 1
+        if self.root is None:
+            self.root = [image_hash, [hex_digest], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(image_hash, node[0])
+            if distance == 0:
+                node[1].append(hex_digest)
+                return
+
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [image_hash, [hex_digest], {}]
+                return
+            node = child
+
+    def search(self, image_hash, max_distance):
+        # [(distance, hex_digest)], nearest first
+        matches = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(image_hash, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, hex_digest) for hex_digest in node[1])
+
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    nodes.append(child)
+
+        return sorted(matches)
+
+
+class PerceptualIndex:
+    # Perceptual hashes of the library, kept in the 'phash' field of the records
+
+    def __init__(self):
+        self.tree = BKTree()
+        for json_image in get_image_catalog().images():
+            if json_image.get('phash'):
+                self.tree.add(json_image['phash'], json_image['hex_digest'])
+
+    def add(self, image_hash, hex_digest):
+        self.tree.add(image_hash, hex_digest)
+
+    def find(self, image_hash, hex_digest=None, max_distance=None):
+        # Near duplicates still in the library, other than the image itself
+        if max_distance is None:
+            max_distance = AppConfig.get_dedupe_distance()
+
+        catalog = get_image_catalog()
+        return [(distance, digest) for distance, digest in self.tree.search(image_hash, max_distance)
+                if digest != hex_digest and catalog.get(digest) is not None]
+
+
+perceptual_index = None
+
+
+def get_perceptual_index():
+    global perceptual_index
+
+    if perceptual_index is None:
+        perceptual_index = PerceptualIndex()
+
+    return perceptual_index
+
+
+def check_near_duplicate(image_json):
+    # Called before storing a new image: sets its 'phash' and, when a similar
+    # image is already in the library, its 'similar_to'. Returns True if the
+    # image has to be rejected.
+    logger = logging.getLogger("check_near_duplicate")
+
+    database_image = get_image_catalog().get(image_json['hex_digest'])
+    if database_image is not None:
+        # Same bytes as a stored image (metadata upgrade), keep what it had
+        for field in ['phash', 'similar_to']:
+            if field in database_image:
+                image_json[field] = database_image[field]
+        return False
+
+    image_file = image_json.get('image_file') or image_json['image_data']
+    image_json['phash'] = get_perceptual_hash(image_file)
+    if 'image_data' in image_json:
+        image_json['image_data'].seek(0)
+
+    index = get_perceptual_index()
+    matches = index.find(image_json['phash'], image_json['hex_digest'])
+
+    if matches:
+        distance, hex_digest = matches[0]
+        similar_image = get_image_catalog().get(hex_digest)
+
+        if AppConfig.get_dedupe_action() == "reject":
+            image_json['near_duplicate_of'] = hex_digest
+            logger.info(f"Rejecting {image_json['title']} / {image_json['hex_digest']}: near duplicate of "
+                        f"{similar_image['image_path']} (distance {distance})")
+            return True
+
+        logger.info(f"{image_json['title']} / {image_json['hex_digest']} is similar to "
+                    f"{similar_image['image_path']} (distance {distance})")
+        image_json['similar_to'] = hex_digest
+
+    index.add(image_json['phash'], image_json['hex_digest'])
+    return False
+
+
+def backfill_perceptual_hashes():
+    # Hashes the library images without a perceptual hash, oldest first, and
+    # links each one to the most similar older image
+    import os
+    import time
+
+    logger = logging.getLogger("backfill_perceptual_hashes")
+    index = get_perceptual_index()
+    start = time.perf_counter()
+    hashed = linked = errors = 0
+
+    for json_image in reversed(read_images_database()):
+        if json_image.get('phash'):
+            continue
+
+        image_full_path = f"{AppConfig.get_output_dir()}/{json_image['image_path']}"
+        if not os.path.isfile(image_full_path):
+            continue
+
+        try:
+            json_image = dict(json_image)
+            json_image['phash'] = get_perceptual_hash(image_full_path)
+        except BaseException as error:
+            logger.error(f"Error hashing {image_full_path}: {error}")
+            errors = errors + 1
+            continue
+
+        matches = index.find(json_image['phash'], json_image['hex_digest'])
+        if matches:
+            json_image['similar_to'] = matches[0][1]
+            linked = linked + 1
+            logger.info(f"{json_image['image_path']} is similar to "
+                        f"{get_image_catalog().get(matches[0][1])['image_path']} (distance {matches[0][0]})")
+
+        index.add(json_image['phash'], json_image['hex_digest'])
+        add_image_to_database(json_image)
+        hashed = hashed + 1
+
+    logger.info(f"{hashed} images hashed in {time.perf_counter() - start:.2f} s, {linked} near duplicates, "
+                f"{errors} errors")
+
+    compact_database()
+
+
+def log_near_duplicates():
+    # Groups of images linked by similar_to, with their digests and paths
+    logger = logging.getLogger("log_near_duplicates")
+
+    groups = {}
+    for json_image in read_images_database():
+        if json_image.get('similar_to'):
+            groups.setdefault(json_image['similar_to'], []).append(json_image)
+
+    for hex_digest, similar_images in groups.items():
+        original = get_image_catalog().get(hex_digest)
+        if original is None:
+            continue
+
+        logger.info(f"{hex_digest} {original['image_path']}")
+        for json_image in similar_images:
+            distance = hamming_distance(original['phash'], json_image['phash'])
+            logger.info(f"  {json_image['hex_digest']} {json_image['image_path']} (distance {distance})")
+
+    logger.info(f"{len(groups)} images with near duplicates")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Near duplicate images by perceptual hash")
+    parser.add_argument("command", choices=["backfill", "list"],
+                        help="backfill: hash the images of the library without a hash, list: show near duplicates")
+    args = parser.parse_args()
+
+    init_configuration()
+    conf_logging()
+
+    if args.command == "backfill":
+        backfill_perceptual_hashes()
+    else:
+        log_near_duplicates()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+import logging
+import threading
+from collections import deque
+
+from utils import *
+
+# New images read from the catalog on every change, more than this resets the clients
+EVENTS_BATCH = 100
+# Subscribers not reading this much output are dropped
+MAX_OUTPUT = 1024 * 1024
+
+
+class EventServer:
+    # Server-Sent Events feed of the new images on its own port. The catalog
+    # generation is polled (a memory read of the shared state of the JSONL log,
+    # one row of the SQLite database), so the images added by the downloader
+    # process are seen here. One thread and a selector serve every subscriber:
+    # an idle one costs a socket.
+
+    def __init__(self, port):
+        self.port = port
+        self.logger = logging.getLogger("events")
+        self.selector = None
+        self.listener = None
+        # socket -> {'input': bytes, 'output': bytearray, 'events': mask, 'subscribed': bool, 'close': bool}
+        self.clients = {}
+        # (generation, events) of the last changes, for the clients resuming with Last-Event-ID
+        self.history = deque()
+        self.first_generation = None
+        self.generation = None
+        self.latest_key = None
+
+    def start(self):
+        self.listen()
+        threading.Thread(target=self.run, name="events", daemon=True).start()
+
+    def serve_forever(self):
+        self.listen()
+        self.run()
+
+    def listen(self):
+        import selectors
+        import socket
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('0.0.0.0', self.port))
+        self.listener.listen(AppConfig.get_web_backlog())
+        self.listener.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+        self.poll()
+        self.logger.info(f"Serving events on port {self.port}")
+
+    def run(self):
+        import selectors
+        import time
+
+        poll_time = AppConfig.get_events_poll()
+        keepalive_time = AppConfig.get_events_keepalive()
+        next_poll = time.monotonic() + poll_time
+        next_keepalive = time.monotonic() + keepalive_time
+
+        while True:
+            for key, mask in self.selector.select(max(0, next_poll - time.monotonic())):
+                if key.fileobj is self.listener:
+                    self.accept()
+                    continue
+
+                try:
+                    if mask & selectors.EVENT_READ:
+                        self.read(key.fileobj)
+                    if mask & selectors.EVENT_WRITE and key.fileobj in self.clients:
+                        self.flush(key.fileobj)
+                except BaseException as error:
+                    # Only this client is dropped, the thread serves all of them
+                    self.logger.error(f"Error serving an events client: {error}")
+                    if key.fileobj in self.clients:
+                        self.close(key.fileobj)
+
+            now = time.monotonic()
+            if now >= next_poll:
+                next_poll = now + poll_time
+                try:
+                    self.poll()
+                except BaseException as error:
+                    self.logger.error(f"Error reading the new images: {error}")
+
+            if now >= next_keepalive:
+                next_keepalive = now + keepalive_time
+                self.broadcast(b": keepalive\n\n")
+
+    @staticmethod
+    def format_event(event, data, generation=None):
+        import json
+
+        lines = [f"event: {event}", f"data: {json.dumps(data)}"]
+        if generation is not None:
+            lines.insert(0, f"id: {generation}")
+
+        return ("\n".join(lines) + "\n\n").encode('utf-8')
+
+    @staticmethod
+    def get_image_event(image_json, count):
+        # Compact record of a new image, enough to show it
+        return {'hex_digest': image_json['hex_digest'], 'title': image_json['title'],
+                'description': image_json['description'], 'timestamp': image_json['timestamp'],
+                'country_name': image_json['country_name'], 'image_url_landscape': image_json['image_url_landscape'],
+                'thumbnail': f"/thumb/{image_json['hex_digest']}/{AppConfig.get_thumbnail_size()}", 'count': count}
+
+    def poll(self):
+        # New images since the last generation: those newer than the latest one seen
+        from catalog import ImageCatalog
+
+        generation = get_database_generation()
+        if generation == self.generation:
+            return
+
+        images, _ = query_images_database(limit=EVENTS_BATCH)
+        keys = [ImageCatalog.get_sort_key(image) for image in images]
+        new_images = [image for image, key in zip(images, keys) if self.latest_key is None or key > self.latest_key]
+        if keys and (self.latest_key is None or keys[0] > self.latest_key):
+            self.latest_key = keys[0]
+
+        if self.generation is None:
+            self.generation = self.first_generation = generation
+            return
+
+        self.generation = generation
+        if not new_images:
+            return
+
+        if len(new_images) == EVENTS_BATCH:
+            # Too many to send one by one (a backup import), the clients reload
+            events = self.format_event("reset", {}, generation)
+        else:
+            count = count_images_database()
+            events = b"".join(self.format_event("image", self.get_image_event(image, count))
+                              for image in reversed(new_images[1:]))
+            # Only the last event of the change has the id, a client resuming
+            # from it has received all of them
+            events += self.format_event("image", self.get_image_event(new_images[0], count), generation)
+
+        if len(self.history) >= AppConfig.get_events_history():
+            self.first_generation = self.history.popleft()[0]
+        self.history.append((generation, events))
+
+        self.logger.debug(f"{len(new_images)} new images sent to {len(self.clients)} clients")
+        self.broadcast(events)
+
+    def get_missed_events(self, last_event_id):
+        if last_event_id is None:
+            # The id of the current generation, to resume from it
+            return self.format_event("ready", {}, self.generation)
+
+        try:
+            generation = int(last_event_id)
+        except ValueError:
+            generation = None
+
+        if generation is not None and generation > self.generation:
+            # A page rendered after the last poll, or by a server before the state
+            # file was reset: no reset, it would reload forever
+            self.poll()
+            if generation > self.generation:
+                return self.format_event("ready", {}, self.generation)
+
+        if generation is None or not self.first_generation <= generation <= self.generation:
+            # Unknown or too old, the client reloads
+            return self.format_event("reset", {}, self.generation)
+
+        return b"".join(events for events_generation, events in self.history if events_generation > generation)
+
+    def accept(self):
+        import selectors
+
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except BlockingIOError:
+                return
+            except OSError as error:
+                self.logger.error(f"Error accepting a connection: {error}")
+                return
+
+            client.setblocking(False)
+            self.selector.register(client, selectors.EVENT_READ)
+            self.clients[client] = {'input': b"", 'output': bytearray(), 'events': selectors.EVENT_READ,
+                                    'subscribed': False, 'close': False}
+
+    def read(self, client):
+        from urllib.parse import parse_qs
+
+        try:
+            data = client.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.close(client)
+            return
+
+        state = self.clients[client]
+        if state['subscribed'] or state['close']:
+            return
+
+        state['input'] = state['input'] + data
+        if b"\r\n\r\n" not in state['input']:
+            if len(state['input']) > 16384:
+                self.close(client)
+            return
+
+        lines = state['input'].split(b"\r\n\r\n")[0].decode('latin1').split("\r\n")
+        method, target = (lines[0].split(" ") + ["", ""])[:2]
+        headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(":") for line in lines[1:])}
+        path, _, query = target.partition("?")
+
+        if method == "OPTIONS":
+            # Preflight of the cross-origin requests with Last-Event-ID (redirects from the web server)
+            self.respond(client, "204 No Content", "Access-Control-Allow-Origin: *\r\n"
+                                                   "Access-Control-Allow-Headers: Last-Event-ID, Cache-Control\r\n")
+        elif method != "GET" or path != "/events":
+            self.respond(client, "404 Not Found", "")
+        else:
+            last_event_id = headers.get('last-event-id') or parse_qs(query).get('lastEventId', [None])[0]
+            # The missed events may poll and broadcast, before this client is a subscriber
+            missed_events = self.get_missed_events(last_event_id)
+            state['subscribed'] = True
+            self.send(client, b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-store\r\n"
+                              b"Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\nretry: 5000\n\n" +
+                      missed_events)
+
+    def respond(self, client, status, headers):
+        self.clients[client]['close'] = True
+        self.send(client, f"HTTP/1.1 {status}\r\n{headers}Content-Length: 0\r\nConnection: close\r\n\r\n".encode())
+
+    def broadcast(self, data):
+        for client, state in list(self.clients.items()):
+            if state['subscribed']:
+                self.send(client, data)
+
+    def send(self, client, data):
+        self.clients[client]['output'] += data
+        self.flush(client)
+
+    def flush(self, client):
+        import selectors
+
+        state = self.clients[client]
+        try:
+            sent = client.send(state['output']) if state['output'] else 0
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close(client)
+            return
+
+        del state['output'][:sent]
+        if len(state['output']) > MAX_OUTPUT or (state['close'] and not state['output']):
+            self.close(client)
+            return
+
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if state['output'] else 0)
+        if events != state['events']:
+            self.selector.modify(client, events)
+            state['events'] = events
+
+    def close(self, client):
+        self.selector.unregister(client)
+        del self.clients[client]
+        client.close()
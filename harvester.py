@@ -0,0 +1,139 @@
+import logging
+
+from utils import *
+
+
+class Harvester:
+    # Polls every (country, language, pid) target concurrently, merges the ad
+    # items and drops repeated images before any image bytes are downloaded.
+    # Keeps how many new images each target yields over time.
+
+    def __init__(self):
+        self.logger = logging.getLogger("harvester")
+        self.yields = self.read_yields()
+        self.targets_by_url = {}
+        # target key -> new images in the last harvest
+        self.iteration_new = {}
+
+    @staticmethod
+    def get_targets():
+        countries = AppConfig.get_harvester_countries() or [AppConfig.get_country()]
+        return [(country, language, str(pid))
+                for country in countries
+                for language in AppConfig.get_harvester_languages()
+                for pid in AppConfig.get_harvester_pids()]
+
+    @staticmethod
+    def get_target_key(target):
+        return "/".join(target)
+
+    @staticmethod
+    def request_images_data(target):
+        country, language, pid = target
+        url = AppConfig.get_spotlight_url(country, pid, language)
+        data = get_http_session().get(url, timeout=AppConfig.get_download_timeout()).json()
+        return list(parse_images_data(data, country))
+
+    async def fetch_all(self, targets):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        concurrency = AppConfig.get_harvester_concurrency()
+        semaphore = asyncio.Semaphore(concurrency)
+        loop = asyncio.get_running_loop()
+
+        async def fetch(executor, target):
+            async with semaphore:
+                try:
+                    return target, await loop.run_in_executor(executor, self.request_images_data, target)
+                except BaseException as error:
+                    self.logger.error(f"Error requesting images for {self.get_target_key(target)}: {error}")
+                    return target, None
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="harvester") as executor:
+            return await asyncio.gather(*(fetch(executor, target) for target in targets))
+
+    def harvest(self, scheduler=None):
+        import asyncio
+        import time
+
+        all_targets = self.get_targets()
+        targets = scheduler.choose_targets(all_targets, self.get_target_key) if scheduler else all_targets
+        start = time.perf_counter()
+        results = asyncio.run(self.fetch_all(targets))
+
+        items = []
+        self.targets_by_url = {}
+        self.iteration_new = {self.get_target_key(target): 0 for target in targets}
+
+        for target, target_items in results:
+            target_yield = self.get_yield(target)
+            target_yield['requests'] += 1
+
+            if target_items is None:
+                target_yield['errors'] += 1
+                continue
+
+            for item in target_items:
+                target_yield['items'] += 1
+                url = item['image_url_landscape']
+                if url in self.targets_by_url:
+                    target_yield['repeated'] += 1
+                    continue
+
+                self.targets_by_url[url] = target
+                items.append(item)
+
+        self.logger.info(f"{len(items)} distinct items from {len(targets)} of {len(all_targets)} targets "
+                         f"in {time.perf_counter() - start:.2f} s")
+
+        return items
+
+    def get_yield(self, target):
+        return self.yields.setdefault(self.get_target_key(target),
+                                      {'requests': 0, 'errors': 0, 'items': 0, 'repeated': 0, 'seen': 0, 'new': 0})
+
+    def record(self, item, new_image):
+        target = self.targets_by_url.get(item['image_url_landscape'])
+        if target is not None:
+            self.get_yield(target)['new' if new_image else 'seen'] += 1
+            if new_image:
+                self.iteration_new[self.get_target_key(target)] += 1
+
+    def log_yields(self):
+        # Best targets first, only the top ones at INFO level
+        ranking = sorted(self.yields.items(), key=lambda x: x[1]['new'] / max(x[1]['requests'], 1), reverse=True)
+        for position, (key, target_yield) in enumerate(ranking):
+            log = self.logger.info if position < 5 else self.logger.debug
+            log(f"{key}: {target_yield['new']} new / {target_yield['seen']} seen / "
+                f"{target_yield['repeated']} repeated items in {target_yield['requests']} requests "
+                f"({target_yield['errors']} errors)")
+
+    @staticmethod
+    def get_yields_name():
+        return f"{AppConfig.get_output_dir()}/{AppConfig.get_harvester_stats_filename()}"
+
+    @staticmethod
+    def read_yields():
+        import json
+        import os
+
+        yields_name = Harvester.get_yields_name()
+        if not os.path.isfile(yields_name):
+            return {}
+
+        try:
+            with open(yields_name, 'r') as file:
+                return json.load(file)
+        except ValueError:
+            return {}
+
+    def save_yields(self):
+        import json
+        import os
+
+        yields_name = self.get_yields_name()
+        with open(f"{yields_name}.tmp", 'w') as file:
+            json.dump(self.yields, file, indent=2)
+
+        os.replace(f"{yields_name}.tmp", yields_name)
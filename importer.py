@@ -0,0 +1,200 @@
+import logging
+import threading
+
+from utils import *
+
+
+class ImportJob:
+    # Imports a backup zip in a background thread: the database embedded in the
+    # archive is read from it, the images already in the library are skipped
+    # with the catalog index, the others are extracted from the archive straight
+    # to their final paths by a pool of threads, and all the rows are added in
+    # one write. The status is kept in a JSON file in the output dir, so any web
+    # process (prefork workers) can report it.
+
+    def __init__(self, archive_path, id_new):
+        self.archive_path = archive_path
+        self.id_new = id_new
+        self.logger = logging.getLogger("import_backup")
+        self.status = {'id': id_new, 'state': "queued", 'images': 0, 'skipped': 0, 'imported': 0,
+                       'downloaded': 0, 'errors': 0, 'message': "", 'start': get_now(), 'end': None}
+        self.status_time = 0
+        # Zip handles of the worker threads
+        self.local = threading.local()
+        self.archives = []
+        self.archives_lock = threading.Lock()
+
+    @staticmethod
+    def get_jobs_dir():
+        return f"{AppConfig.get_output_dir()}/{AppConfig.get_import_jobs_dirname()}"
+
+    @staticmethod
+    def get_status_name(id_new):
+        return f"{ImportJob.get_jobs_dir()}/{id_new}.json"
+
+    @staticmethod
+    def read_status(id_new):
+        import json
+        import os
+
+        status_name = ImportJob.get_status_name(os.path.basename(id_new))
+        if not os.path.isfile(status_name):
+            return None
+
+        with open(status_name, 'r') as file:
+            return json.load(file)
+
+    def save_status(self, force=False):
+        # At most twice a second while the import runs
+        import json
+        import os
+        import time
+
+        if not force and time.time() - self.status_time < 0.5:
+            return
+
+        self.status_time = time.time()
+        status_name = self.get_status_name(self.id_new)
+        with open(f"{status_name}.tmp", 'w') as file:
+            json.dump(self.status, file)
+
+        os.replace(f"{status_name}.tmp", status_name)
+
+    @staticmethod
+    def delete_old_jobs():
+        import os
+        import time
+
+        for file in os.listdir(ImportJob.get_jobs_dir()):
+            path = os.path.join(ImportJob.get_jobs_dir(), file)
+            if time.time() - os.path.getmtime(path) > 24 * 3600:
+                os.remove(path)
+
+    def start(self):
+        import os
+
+        os.makedirs(self.get_jobs_dir(), exist_ok=True)
+        self.delete_old_jobs()
+        self.save_status(force=True)
+
+        threading.Thread(target=self.run, name=f"import-{self.id_new}", daemon=True).start()
+
+    def run(self):
+        import os
+        import time
+
+        start = time.perf_counter()
+        try:
+            self.import_backup()
+            self.status['state'] = "done"
+        except BaseException as error:
+            self.logger.error(f"Error importing {self.archive_path}: {error}")
+            self.status['state'] = "failed"
+            self.status['message'] = str(error)
+        finally:
+            os.remove(self.archive_path)
+            self.status['end'] = get_now()
+            self.save_status(force=True)
+
+        self.logger.info(f"Backup {self.id_new} imported in {time.perf_counter() - start:.2f} s: "
+                         f"{self.status['imported']} images imported, {self.status['downloaded']} downloaded, "
+                         f"{self.status['skipped']} already in the library, {self.status['errors']} errors")
+
+    def read_backup_database(self, archive):
+        import io
+        from catalog import ImageCatalog
+
+        images = {}
+        with archive.open(AppConfig.get_json_filename()) as file:
+            for line in io.TextIOWrapper(file, encoding='utf-8'):
+                if line.strip():
+                    image = ImageCatalog.parse_record(line)
+                    images[image['hex_digest']] = image
+
+        return list(images.values())
+
+    def get_archive(self):
+        import zipfile
+
+        archive = getattr(self.local, 'archive', None)
+        if archive is None:
+            archive = self.local.archive = zipfile.ZipFile(self.archive_path)
+            with self.archives_lock:
+                self.archives.append(archive)
+
+        return archive
+
+    def extract_image(self, image, member):
+        import os
+        import shutil
+
+        temp_file = f"{image['image_full_path']}.tmp"
+        try:
+            with self.get_archive().open(member) as source, open(temp_file, 'wb') as destination:
+                shutil.copyfileobj(source, destination, 1024 * 1024)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+        os.replace(temp_file, image['image_full_path'])
+
+    def import_backup(self):
+        import zipfile
+        from concurrent.futures import ThreadPoolExecutor
+        from thumbnails import schedule_thumbnails
+
+        self.status['state'] = "reading"
+        self.save_status(force=True)
+
+        with zipfile.ZipFile(self.archive_path) as archive:
+            members = set(archive.namelist())
+            images = self.read_backup_database(archive)
+
+        new_images = [image for image in images if not exists_image(image)]
+        self.status.update({'state': "importing", 'images': len(images), 'skipped': len(images) - len(new_images)})
+        self.save_status(force=True)
+
+        imported = []
+        missing = []
+        try:
+            with ThreadPoolExecutor(max_workers=AppConfig.get_import_threads(), thread_name_prefix="import") as executor:
+                extractions = []
+                for image in new_images:
+                    member = image['image_path']
+                    if member not in members:
+                        missing.append(image)
+                        continue
+
+                    make_image_directory(image)
+                    extractions.append((image, executor.submit(self.extract_image, image, member)))
+
+                for image, extraction in extractions:
+                    try:
+                        extraction.result()
+                        imported.append(image)
+                        self.status['imported'] += 1
+                    except BaseException as error:
+                        self.logger.error(f"Error extracting {image['image_path']}: {error}")
+                        self.status['errors'] += 1
+                    self.save_status()
+        finally:
+            for archive in self.archives:
+                archive.close()
+
+        for image in imported:
+            image['timestamp'] = get_now()
+            image['id-new'] = self.id_new
+
+        add_images_to_database(imported)
+        for image in imported:
+            schedule_thumbnails(image)
+
+        # Images of the database missing in the archive are downloaded again
+        for image in missing:
+            self.logger.error(f"{image['image_path']} is not in the backup, downloading it")
+            if process_image(image):
+                self.status['downloaded'] += 1
+            else:
+                self.status['errors'] += 1
+            self.save_status()
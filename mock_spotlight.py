@@ -0,0 +1,173 @@
+import logging
+import threading
+
+# Smallest valid baseline JPEG (1x1 pixel). Assets are this image plus a JPEG
+# comment segment that makes every asset unique and sets the payload size.
+BASE_JPEG = bytes.fromhex(
+    "ffd8ffe000104a46494600010101004800480000ffdb004300ffffffffffffffffffffffffffffffffffffffffffffff"
+    "ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff"
+    "ffc2000b080001000101011100ffc40014100100000000000000000000000000000000ffda0008010100013f10ffd9")
+
+TITLES = ["Lake Como, Italy", "Moraine Lake, Canada", "Torres del Paine, Chile", "Mount Fuji, Japan",
+          "Zhangjiajie, China", "Isle of Skye, Scotland", "Namib Desert, Namibia", "Lofoten, Norway",
+          "Great Barrier Reef, Australia", "Cappadocia, Turkey", "Andromeda Galaxy", "Starry Night, Painting"]
+
+
+class MockSpotlight:
+    # Local stand-in for the Spotlight Placement endpoint. Serves batchrsp
+    # payloads whose items point to JPEG assets served by the same server, with
+    # a tunable share of items repeating assets already served.
+
+    def __init__(self, items=4, duplicate_ratio=0.8, latency=0.0, asset_size=500 * 1024, seed=None):
+        import random
+
+        self.items = items
+        self.duplicate_ratio = duplicate_ratio
+        self.latency = latency
+        self.asset_size = asset_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.served_assets = []
+        self.requests = 0
+        self.server = None
+
+    def next_asset(self):
+        with self.lock:
+            if self.served_assets and self.random.random() < self.duplicate_ratio:
+                return self.random.choice(self.served_assets)
+
+            asset_id = f"MOCK{len(self.served_assets):08d}"
+            self.served_assets.append(asset_id)
+            return asset_id
+
+    def get_asset(self, asset_id):
+        comment = f"spotlight-dl mock asset {asset_id} ".encode()
+        padding = max(self.asset_size - len(BASE_JPEG) - 4 - len(comment), 0)
+
+        # Comment segments are limited to 65533 bytes of payload each
+        segments = []
+        payload = comment + b"\x00" * padding
+        for start in range(0, len(payload), 65533):
+            chunk = payload[start:start + 65533]
+            segments.append(b"\xff\xfe" + (len(chunk) + 2).to_bytes(2, "big") + chunk)
+
+        return BASE_JPEG[:2] + b"".join(segments) + BASE_JPEG[2:]
+
+    def get_batch(self, base_url):
+        import json
+
+        items = []
+        for _ in range(self.items):
+            asset_id = self.next_asset()
+            title = TITLES[int(asset_id[4:]) % len(TITLES)]
+            ad = {
+                'image_fullscreen_001_landscape': {'u': f"{base_url}/assets/{asset_id}.jpg?ver=1"},
+                'image_fullscreen_001_portrait': {'u': f"{base_url}/assets/{asset_id}-portrait.jpg?ver=1"},
+                'title_text': {'tx': title},
+                'hs1_title_text': {'tx': f"About {title.split(',')[0]}"},
+                'hs1_cta_text': {'tx': "A place worth the trip"},
+                'hs2_title_text': {'tx': "Did you know?"},
+                'hs2_cta_text': {'tx': f"Asset {asset_id}"},
+                'copyright_text': {'tx': "© spotlight-dl mock"},
+            }
+            items.append({'item': json.dumps({'ad': ad})})
+
+        return {'batchrsp': {'ver': "1.0", 'items': items}}
+
+    def start(self, host="127.0.0.1", port=0):
+        from http.server import ThreadingHTTPServer
+
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="mock-spotlight", daemon=True).start()
+
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def get_placement_url(self, base_url):
+        # Value for spotlight.url, the placeholders are filled but ignored
+        return (f"{base_url}/v3/Delivery/Placement?pid=${{pid}}&fmt=json&pl=${{language}}&lc=${{language}}"
+                f"&ctry=${{country}}&time=${{time}}")
+
+    def make_handler(self):
+        import json
+        import time
+        from http.server import BaseHTTPRequestHandler
+
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if mock.latency:
+                    time.sleep(mock.latency)
+
+                path = self.path.split("?")[0]
+                if path.startswith("/v3/Delivery/Placement"):
+                    with mock.lock:
+                        mock.requests = mock.requests + 1
+                    base_url = f"http://{self.headers.get('Host')}"
+                    self.send(json.dumps(mock.get_batch(base_url)).encode(), "application/json")
+
+                elif path.startswith("/assets/"):
+                    asset_id = path[len("/assets/"):].split(".")[0].replace("-portrait", "")
+                    self.send(mock.get_asset(asset_id), "image/jpeg", etag=f'"{asset_id}"')
+
+                else:
+                    self.send_error(404)
+
+            def send(self, body, content_type, etag=None):
+                if etag and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('Content-Length', "0")
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if etag:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.getLogger("mock_spotlight").debug(format % args)
+
+        return Handler
+
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the Spotlight Placement endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--items", type=int, default=4, help="Items per batchrsp")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.8, help="Share of items repeating assets")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--size", type=int, default=500, help="Asset size in KB")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    mock = MockSpotlight(args.items, args.duplicate_ratio, args.latency, args.size * 1024, args.seed)
+    base_url = mock.start(args.host, args.port)
+
+    logging.getLogger("mock_spotlight").info(f"Set spotlight.url (or SPOTLIGHTDL_SPOTLIGHT_URL) to "
+                                             f"{mock.get_placement_url(base_url)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    # Rendered pages by (route, query, page), valid for one generation of the
+    # catalog. Least recently used pages are evicted beyond max_bytes.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (generation, body)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.misses = self.misses + 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return entry[1]
+
+    def put(self, key, generation, body):
+        if len(body) > self.max_bytes:
+            return
+
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (generation, body)
+            self.size = self.size + len(body)
+
+            while self.size > self.max_bytes:
+                _, (_, evicted_body) = self.entries.popitem(last=False)
+                self.size = self.size - len(evicted_body)
+                self.evictions = self.evictions + 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size = self.size - len(entry[1])
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes}
@@ -0,0 +1,89 @@
+import logging
+
+from utils import *
+
+
+class PollScheduler:
+    # Replaces the fixed sleep between iterations: the interval backs off
+    # exponentially while polls find nothing new, tightens when new images show
+    # up and is jittered. It also keeps the novelty (moving average of new images
+    # per request) of every country/pid target, and picks countries by it, or
+    # the targets the harvester polls.
+
+    smoothing = 0.3
+    # Novelty of a target never polled, optimistic so every target gets tried
+    prior = 1.0
+    # Floor of the weights, so unproductive targets are still polled now and then
+    exploration = 0.05
+
+    def __init__(self):
+        import random
+
+        self.logger = logging.getLogger("scheduler")
+        # Own generator: get_random_pid() seeds the global one with the current time
+        self.random = random.Random()
+        self.min_time = AppConfig.get_scheduler_min_time()
+        self.max_time = AppConfig.get_scheduler_max_time()
+        self.interval = min(max(AppConfig.get_sleep_time(), self.min_time), self.max_time)
+        self.novelty = {}
+        self.requests = 0
+        self.new_images = 0
+
+    @staticmethod
+    def get_target_key(country, pid):
+        return f"{country}/{pid}"
+
+    def choose_target(self):
+        country = AppConfig.get_configuration_item('spotlight', 'country', "").upper()
+        pid = AppConfig.get_configuration_item('spotlight', 'pid', AppConfig.get_random_pid())
+
+        if not country:
+            countries = list(AppConfig.countries.keys())
+            weights = [self.novelty.get(self.get_target_key(code, pid), self.prior) + self.exploration
+                       for code in countries]
+            country = self.random.choices(countries, weights=weights)[0]
+
+        return country, pid
+
+    def choose_targets(self, targets, get_target_key):
+        # Each harvester target is polled with a probability following its novelty:
+        # the most productive ones every time, the others now and then
+        weights = [self.novelty.get(get_target_key(target), self.prior) + self.exploration for target in targets]
+        best = max(weights, default=0)
+        return [target for target, weight in zip(targets, weights) if self.random.random() < weight / best]
+
+    def record(self, target_key, requests, new_images):
+        self.requests = self.requests + requests
+        self.new_images = self.new_images + new_images
+
+        novelty = new_images / max(requests, 1)
+        previous = self.novelty.get(target_key, self.prior)
+        self.novelty[target_key] = previous + self.smoothing * (novelty - previous)
+
+    def next_interval(self, requests, new_images):
+        if new_images:
+            self.interval = max(self.min_time, self.interval * AppConfig.get_scheduler_tighten())
+            decision = "tighten"
+        else:
+            self.interval = min(self.max_time, self.interval * AppConfig.get_scheduler_backoff())
+            decision = "back off"
+
+        jitter = AppConfig.get_scheduler_jitter()
+        seconds = self.interval * self.random.uniform(1 - jitter, 1 + jitter)
+
+        self.logger.info(f"{new_images} new images in {requests} requests: {decision}, next poll in {seconds:.0f} s "
+                         f"(interval {self.interval:.0f} s, {self.new_images / max(self.requests, 1):.2f} new images "
+                         f"per request since startup)")
+
+        return seconds
+
+    def log_novelty(self):
+        ranking = sorted(self.novelty.items(), key=lambda x: x[1], reverse=True)[:5]
+        self.logger.info("Most productive targets: " + ", ".join(f"{key} {novelty:.2f}" for key, novelty in ranking))
+
+    def sleep(self, requests, new_images):
+        import time
+
+        seconds = self.next_interval(requests, new_images)
+        self.log_novelty()
+        time.sleep(seconds)
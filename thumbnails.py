@@ -0,0 +1,128 @@
+import logging
+import threading
+
+from utils import *
+
+# One background thread per process makes the thumbnails of new images
+thumbnail_executor = None
+thumbnail_executor_pid = None
+thumbnail_executor_lock = threading.Lock()
+# Estimate of the cache size in bytes, corrected on every eviction scan
+cache_bytes = None
+
+
+def get_thumbnails_dir():
+    return f"{AppConfig.get_output_dir()}/{AppConfig.get_thumbnails_dirname()}"
+
+
+def get_thumbnail_path(hex_digest, size):
+    # Content addressed: the pixels of a digest never change, only its EXIF tags
+    return f"{get_thumbnails_dir()}/{size}/{hex_digest[:2]}/{hex_digest}.jpg"
+
+
+def make_thumbnail(image_full_path, hex_digest, size):
+    # JPEGs are decoded at the smallest DCT scale above the thumbnail size
+    # (draft) and reduced before resampling, so the full image is never decoded
+    import os
+    import tempfile
+    from PIL import Image
+
+    global cache_bytes
+
+    thumbnail_path = get_thumbnail_path(hex_digest, size)
+    if os.path.isfile(thumbnail_path):
+        return thumbnail_path
+
+    with Image.open(image_full_path) as picture:
+        picture.draft('RGB', (size, size))
+        picture = picture.convert('RGB')
+        picture.thumbnail((size, size), Image.LANCZOS, reducing_gap=2.0)
+
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        file_descriptor, temp_file = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(thumbnail_path))
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                picture.save(file, "JPEG", quality=AppConfig.get_thumbnail_quality(), optimize=True)
+            os.replace(temp_file, thumbnail_path)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+
+    if cache_bytes is not None:
+        cache_bytes = cache_bytes + os.path.getsize(thumbnail_path)
+    if cache_bytes is None or cache_bytes > AppConfig.get_thumbnail_cache_size():
+        evict_thumbnails()
+
+    return thumbnail_path
+
+
+def make_thumbnails(image_full_path, hex_digest):
+    logger = logging.getLogger("make_thumbnails")
+
+    try:
+        for size in AppConfig.get_thumbnail_sizes():
+            make_thumbnail(image_full_path, hex_digest, size)
+    except BaseException as error:
+        logger.error(f"Error making the thumbnails of {image_full_path}: {error}")
+
+
+def schedule_thumbnails(image_json):
+    # Thumbnails of a new image, made in the background
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
+    global thumbnail_executor, thumbnail_executor_pid
+
+    with thumbnail_executor_lock:
+        # The thread of the executor is not copied by a fork, a forked process makes its own
+        if thumbnail_executor is None or thumbnail_executor_pid != os.getpid():
+            thumbnail_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnails")
+            thumbnail_executor_pid = os.getpid()
+
+    thumbnail_executor.submit(make_thumbnails, image_json['image_full_path'], image_json['hex_digest'])
+
+
+def touch_thumbnail(thumbnail_path):
+    # The mtime is the last use for the LRU eviction, updated at most once an hour
+    import os
+    import time
+
+    if time.time() - os.path.getmtime(thumbnail_path) > 3600:
+        os.utime(thumbnail_path)
+
+
+def evict_thumbnails():
+    # Removes the least recently used thumbnails until the cache is 10% below its budget
+    import os
+
+    global cache_bytes
+
+    logger = logging.getLogger("evict_thumbnails")
+    budget = AppConfig.get_thumbnail_cache_size()
+
+    thumbnails = []
+    for root, _, files in os.walk(get_thumbnails_dir()):
+        for file in files:
+            try:
+                stat = os.stat(os.path.join(root, file))
+            except FileNotFoundError:
+                continue
+            thumbnails.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+
+    cache_bytes = sum(size for _, size, _ in thumbnails)
+    if cache_bytes <= budget:
+        return
+
+    evicted = 0
+    thumbnails.sort()
+    for _, size, path in thumbnails:
+        if cache_bytes <= budget * 0.9:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_bytes = cache_bytes - size
+        evicted = evicted + 1
+
+    logger.info(f"{evicted} thumbnails evicted, {cache_bytes / 1024 / 1024:.1f} MB in the cache")
@@ -25,12 +25,14 @@ class AppConfig:
             return url
 
     @staticmethod
-    def get_spotlight_url(country):
+    def get_spotlight_url(country, pid=None, language=None):
         from datetime import datetime
 
         url = AppConfig.get_configuration_item('spotlight', 'url')
-        pid = AppConfig.get_configuration_item('spotlight', 'pid', AppConfig.get_random_pid())
-        language = AppConfig.get_language()
+        if pid is None:
+            pid = AppConfig.get_configuration_item('spotlight', 'pid', AppConfig.get_random_pid())
+        if language is None:
+            language = AppConfig.get_language()
 
         return (url
                 .replace("${pid}", str(pid))
@@ -93,6 +95,200 @@ class AppConfig:
     def get_json_filename():
         return AppConfig.get_configuration_item('general', 'json.filename')
 
+    @staticmethod
+    def get_storage():
+        return AppConfig.get_configuration_item('general', 'storage', 'jsonl').lower()
+
+    @staticmethod
+    def get_sqlite_filename():
+        return AppConfig.get_configuration_item('general', 'sqlite.filename', 'images_database.sqlite')
+
+    @staticmethod
+    def get_state_filename():
+        return AppConfig.get_configuration_item('general', 'state.filename', '.images_database.state')
+
+    @staticmethod
+    def get_compaction_ratio():
+        return float(AppConfig.get_configuration_item('general', 'compaction.ratio', 0.2))
+
+    @staticmethod
+    def get_manifest_filename():
+        return AppConfig.get_configuration_item('general', 'manifest.filename', '.images_manifest.json')
+
+    @staticmethod
+    def get_links_reconcile_time():
+        return int(AppConfig.get_configuration_item('general', 'links.reconcile.time', 0))
+
+    @staticmethod
+    def get_download_threads():
+        return int(AppConfig.get_configuration_item('download', 'threads', 4))
+
+    @staticmethod
+    def get_download_connections_per_host():
+        return int(AppConfig.get_configuration_item('download', 'connections.per.host', 4))
+
+    @staticmethod
+    def get_download_timeout():
+        return int(AppConfig.get_configuration_item('download', 'timeout', 60))
+
+    @staticmethod
+    def is_harvester_enabled():
+        return str(AppConfig.get_configuration_item('harvester', 'enabled', False)).lower() == "true"
+
+    @staticmethod
+    def get_harvester_countries():
+        return [country.upper() for country in AppConfig.get_configuration_list('harvester', 'countries')]
+
+    @staticmethod
+    def get_harvester_languages():
+        return AppConfig.get_configuration_list('harvester', 'languages') or [AppConfig.get_language()]
+
+    @staticmethod
+    def get_harvester_pids():
+        return AppConfig.get_configuration_list('harvester', 'pids') or [
+            AppConfig.get_configuration_item('spotlight', 'pid', AppConfig.get_random_pid())]
+
+    @staticmethod
+    def get_harvester_concurrency():
+        return int(AppConfig.get_configuration_item('harvester', 'concurrency', 8))
+
+    @staticmethod
+    def get_harvester_stats_filename():
+        return AppConfig.get_configuration_item('harvester', 'stats.filename', '.harvester_stats.json')
+
+    @staticmethod
+    def get_download_max_size():
+        return int(AppConfig.get_configuration_item('download', 'max.size.mb', 50)) * 1024 * 1024
+
+    @staticmethod
+    def get_seen_urls_filename():
+        return AppConfig.get_configuration_item('download', 'seen.urls.filename', '.seen_urls.jsonl')
+
+    @staticmethod
+    def is_scheduler_enabled():
+        return str(AppConfig.get_configuration_item('scheduler', 'enabled', False)).lower() == "true"
+
+    @staticmethod
+    def get_scheduler_min_time():
+        return float(AppConfig.get_configuration_item('scheduler', 'min.time', 60))
+
+    @staticmethod
+    def get_scheduler_max_time():
+        return float(AppConfig.get_configuration_item('scheduler', 'max.time', 3600))
+
+    @staticmethod
+    def get_scheduler_backoff():
+        return float(AppConfig.get_configuration_item('scheduler', 'backoff', 2))
+
+    @staticmethod
+    def get_scheduler_tighten():
+        return float(AppConfig.get_configuration_item('scheduler', 'tighten', 0.5))
+
+    @staticmethod
+    def get_scheduler_jitter():
+        return float(AppConfig.get_configuration_item('scheduler', 'jitter', 0.2))
+
+    @staticmethod
+    def is_dedupe_enabled():
+        return str(AppConfig.get_configuration_item('dedupe', 'enabled', False)).lower() == "true"
+
+    @staticmethod
+    def get_dedupe_distance():
+        return int(AppConfig.get_configuration_item('dedupe', 'distance', 6))
+
+    @staticmethod
+    def get_dedupe_action():
+        return AppConfig.get_configuration_item('dedupe', 'action', "link").lower()
+
+    @staticmethod
+    def get_similarity_threshold():
+        return float(AppConfig.get_configuration_item('similarity', 'threshold', 0.95))
+
+    @staticmethod
+    def get_similarity_block_size():
+        return int(AppConfig.get_configuration_item('similarity', 'block.size', 2048))
+
+    @staticmethod
+    def get_similarity_thumbnails_filename():
+        return AppConfig.get_configuration_item('similarity', 'thumbnails.filename', '.thumbnails.npy')
+
+    @staticmethod
+    def get_similarity_state_filename():
+        return AppConfig.get_configuration_item('similarity', 'state.filename', '.similarity.json')
+
+    @staticmethod
+    def get_web_server():
+        return AppConfig.get_configuration_item('web', 'server', "wsgiref").lower()
+
+    @staticmethod
+    def get_web_threads():
+        return int(AppConfig.get_configuration_item('web', 'threads', 8))
+
+    @staticmethod
+    def get_web_workers():
+        return int(AppConfig.get_configuration_item('web', 'workers', 2))
+
+    @staticmethod
+    def get_web_backlog():
+        return int(AppConfig.get_configuration_item('web', 'backlog', 64))
+
+    @staticmethod
+    def get_web_cache_size():
+        return int(AppConfig.get_configuration_item('web', 'cache.size.mb', 32)) * 1024 * 1024
+
+    @staticmethod
+    def get_events_port():
+        return int(AppConfig.get_configuration_item('web', 'events.port', 8001))
+
+    @staticmethod
+    def get_events_url():
+        return (AppConfig.get_configuration_item('web', 'events.url', "") or "").strip()
+
+    @staticmethod
+    def get_events_poll():
+        return float(AppConfig.get_configuration_item('web', 'events.poll', 1))
+
+    @staticmethod
+    def get_events_history():
+        return int(AppConfig.get_configuration_item('web', 'events.history', 100))
+
+    @staticmethod
+    def get_events_keepalive():
+        return float(AppConfig.get_configuration_item('web', 'events.keepalive', 30))
+
+    @staticmethod
+    def get_thumbnail_size():
+        return int(AppConfig.get_configuration_item('thumbnails', 'size', 640))
+
+    @staticmethod
+    def get_thumbnail_sizes():
+        sizes = [int(size) for size in AppConfig.get_configuration_list('thumbnails', 'sizes')]
+        return sizes or [AppConfig.get_thumbnail_size()]
+
+    @staticmethod
+    def get_thumbnail_quality():
+        return int(AppConfig.get_configuration_item('thumbnails', 'quality', 80))
+
+    @staticmethod
+    def get_thumbnail_cache_size():
+        return int(AppConfig.get_configuration_item('thumbnails', 'cache.size.mb', 500)) * 1024 * 1024
+
+    @staticmethod
+    def get_thumbnails_dirname():
+        return AppConfig.get_configuration_item('thumbnails', 'dir', '.thumbnails')
+
+    @staticmethod
+    def get_import_threads():
+        return int(AppConfig.get_configuration_item('import', 'threads', 4))
+
+    @staticmethod
+    def get_import_jobs_dirname():
+        return AppConfig.get_configuration_item('import', 'jobs.dir', '.import_jobs')
+
+    @staticmethod
+    def get_api_max_limit():
+        return int(AppConfig.get_configuration_item('general', 'api.max.limit', 100))
+
     @staticmethod
     def get_output_dir():
         return AppConfig.get_configuration_item('general', 'output.dir')
@@ -128,6 +324,15 @@ class AppConfig:
 
         return value
 
+    @staticmethod
+    def get_configuration_list(section, item):
+        # Lists can be given as YAML lists or as comma separated strings (environment)
+        value = AppConfig.get_configuration_item(section, item, "")
+        if isinstance(value, list):
+            return [str(element).strip() for element in value if str(element).strip()]
+
+        return [element.strip() for element in str(value).split(",") if element.strip()]
+
     @staticmethod
     def get_random_pid(lower_bound = 200000, upper_bound = 209999):
         import random
@@ -174,53 +379,59 @@ def join_lines(line1_arg, line2_arg):
         return f"{line1} {line2}"
 
 
-def get_images_data():
-    import requests
-    import json
+def get_images_data(country=None, pid=None):
     import logging
     import traceback
 
     logger = logging.getLogger("get_images_data")
     try:
 
-        country = AppConfig.get_country()
-        data = requests.get(AppConfig.get_spotlight_url(country)).json()
+        if country is None:
+            country = AppConfig.get_country()
+        url = AppConfig.get_spotlight_url(country, pid)
+        data = get_http_session().get(url, timeout=AppConfig.get_download_timeout()).json()
 
-        if 'items' in data['batchrsp']:
-            for i, items in enumerate(data['batchrsp']['items']):
-                mi_diccionario = json.loads(items['item'])['ad']
+        yield from parse_images_data(data, country)
 
-                image_url_landscape = mi_diccionario['image_fullscreen_001_landscape']['u']
-                image_url_portrait = mi_diccionario['image_fullscreen_001_portrait']['u']
-                title = get_text(mi_diccionario, 'title_text')
+    except BaseException as error:
+        logger.error(f"Error requesting images: {error}")
+        traceback.print_exc()
 
-                if not title:
-                    title = "Unknown"
 
-                hs1_title = get_text(mi_diccionario, 'hs1_title_text')
-                hs2_title = get_text(mi_diccionario, 'hs2_title_text')
-                hs1_cta_text = get_text(mi_diccionario, 'hs1_cta_text')
-                hs2_cta_text = get_text(mi_diccionario, 'hs2_cta_text')
-                copyright_text = get_text(mi_diccionario, 'copyright_text')
+def parse_images_data(data, country):
+    import json
 
-                description = f"{join_lines(hs1_title, hs1_cta_text)}. {join_lines(hs2_title, hs2_cta_text)}"
-                if description.strip() == ".":
-                    description = ""
+    if 'items' in data['batchrsp']:
+        for i, items in enumerate(data['batchrsp']['items']):
+            mi_diccionario = json.loads(items['item'])['ad']
 
-                for ad_text in AppConfig.get_ad():
-                    if ad_text in description:
-                        description = ""
+            image_url_landscape = mi_diccionario['image_fullscreen_001_landscape']['u']
+            image_url_portrait = mi_diccionario['image_fullscreen_001_portrait']['u']
+            title = get_text(mi_diccionario, 'title_text')
 
-                yield {"image_url_landscape": image_url_landscape, "image_url_portrait": image_url_portrait,
-                       "title": title, "description": description, "copyright": copyright_text,
-                       "hs1_title": hs1_title, "hs2_title": hs2_title, "hs1_cta_text": hs1_cta_text,
-                       "hs2_cta_text": hs2_cta_text,
-                       "country": country, "country_name": AppConfig.get_country_name(country)
-                       }
+            if not title:
+                title = "Unknown"
 
-    except BaseException as error:
-        logger.error(f"Error requesting images: {error}")
-        traceback.print_exc()
+            hs1_title = get_text(mi_diccionario, 'hs1_title_text')
+            hs2_title = get_text(mi_diccionario, 'hs2_title_text')
+            hs1_cta_text = get_text(mi_diccionario, 'hs1_cta_text')
+            hs2_cta_text = get_text(mi_diccionario, 'hs2_cta_text')
+            copyright_text = get_text(mi_diccionario, 'copyright_text')
+
+            description = f"{join_lines(hs1_title, hs1_cta_text)}. {join_lines(hs2_title, hs2_cta_text)}"
+            if description.strip() == ".":
+                description = ""
+
+            for ad_text in AppConfig.get_ad():
+                if ad_text in description:
+                    description = ""
+
+            yield {"image_url_landscape": image_url_landscape, "image_url_portrait": image_url_portrait,
+                   "title": title, "description": description, "copyright": copyright_text,
+                   "hs1_title": hs1_title, "hs2_title": hs2_title, "hs1_cta_text": hs1_cta_text,
+                   "hs2_cta_text": hs2_cta_text,
+                   "country": country, "country_name": AppConfig.get_country_name(country)
+                   }
 
 
 def get_text(dictionary, key):
@@ -230,28 +441,138 @@ def get_text(dictionary, key):
         return ''
 
 
-def download_image(image_json):
+http_session = None
+http_session_pid = None
+
+
+def get_http_session():
+    # Shared session so downloads reuse keep-alive connections. The pool blocks
+    # when all the connections to a host are busy, which caps requests per host.
+    import os
     import requests
-    from io import BytesIO
+    from requests.adapters import HTTPAdapter
+
+    global http_session, http_session_pid
+
+    if http_session is None or http_session_pid != os.getpid():
+        connections = AppConfig.get_download_connections_per_host()
+        adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections, pool_block=True)
+
+        http_session = requests.Session()
+        http_session.mount("http://", adapter)
+        http_session.mount("https://", adapter)
+        http_session_pid = os.getpid()
+
+    return http_session
+
+
+def download_image(image_json, etag=None, etag_digest=None):
+    # The response is streamed in chunks into a temp file while it is hashed, so
+    # memory does not depend on the image size. With an ETag of a known asset
+    # the request is conditional: on a 304 the image gets the digest of the
+    # asset and no image file. Returns the ETag.
+    import os
+    import tempfile
     from hashlib import md5
 
-    image_response = requests.get(image_json['image_url_landscape'])
-    image_data = BytesIO(image_response.content)
+    headers = {'If-None-Match': etag} if etag else {}
+    max_size = AppConfig.get_download_max_size()
+
+    with get_http_session().get(image_json['image_url_landscape'], headers=headers, stream=True,
+                                timeout=AppConfig.get_download_timeout()) as image_response:
+
+        if etag and image_response.status_code == 304:
+            image_json['hex_digest'] = etag_digest
+            return etag
+
+        image_response.raise_for_status()
+
+        md5sum = md5()
+        image_size = 0
+        file_descriptor, image_file = tempfile.mkstemp(prefix="spotlight-dl-", suffix=".jpg")
+
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                for chunk in image_response.iter_content(chunk_size=64 * 1024):
+                    image_size = image_size + len(chunk)
+                    if image_size > max_size:
+                        raise ValueError(f"Image bigger than {max_size} bytes")
+
+                    md5sum.update(chunk)
+                    file.write(chunk)
+        except BaseException:
+            os.remove(image_file)
+            raise
+
+    image_json['hex_digest'] = md5sum.hexdigest()
+    image_json['image_file'] = image_file
+    image_json['image_size'] = image_size
+
+    return image_response.headers.get('ETag')
+
+
+def discard_image_data(image_json):
+    # Drops the image bytes kept with the item, removing the downloaded temp file
+    import os
+
+    image_json.pop('image_data', None)
+    image_json.pop('image_size', None)
+
+    image_file = image_json.pop('image_file', None)
+    if image_file and os.path.exists(image_file):
+        os.remove(image_file)
+
+
+seen_url_index = None
+
+
+def get_seen_url_index():
+    from catalog import SeenUrlIndex
+
+    global seen_url_index
+
+    if seen_url_index is None:
+        seen_url_index = SeenUrlIndex(get_seen_urls_name(), get_image_catalog().images())
+
+    return seen_url_index
 
-    md5sum = md5(image_data.getbuffer())
-    hex_digest = md5sum.hexdigest()
 
-    image_json['hex_digest'] = hex_digest
-    image_json['image_data'] = image_data
+def get_seen_urls_name():
+    return f"{AppConfig.get_output_dir()}/{AppConfig.get_seen_urls_filename()}"
+
+
+def get_local_image_path(hex_digest):
+    # Path of the image file already in the library, if any
+    import os
+
+    image = get_image_catalog().get(hex_digest)
+    if image is None:
+        return None
+
+    image_full_path = f"{AppConfig.get_output_dir()}/{image['image_path']}"
+    return image_full_path if os.path.isfile(image_full_path) else None
 
 
 def save_image(image_json):
-    from PIL import Image
+    # The original JPEG bytes are saved as they are, with the EXIF tags added in
+    # memory, in a single write to a temp file renamed to the final path
+    import os
 
     make_image_directory(image_json)
 
-    image = Image.open(image_json['image_data'])
-    image.save(image_json['image_full_path'])
+    if 'image_file' in image_json:
+        with open(image_json['image_file'], 'rb') as file:
+            image_data = file.read()
+    else:
+        image_data = image_json['image_data'].getvalue()
+
+    image_data = tag_image_data(image_data, image_json)
+
+    temp_file = f"{image_json['image_full_path']}.tmp"
+    with open(temp_file, 'wb') as file:
+        file.write(image_data)
+
+    os.replace(temp_file, image_json['image_full_path'])
 
 
 def make_image_directory(image_json):
@@ -290,74 +611,239 @@ def get_description(image_json):
 
 def clean_database():
     import logging
+    import time
+
     logger = logging.getLogger("clean_database")
+    timings = {}
+
+    start = time.perf_counter()
     database = read_images_database()
+    timings['load'] = time.perf_counter() - start
 
     logger.info(f"Cleaning {len(database)} items of {get_json_database_name()} database ...")
 
-    remove_database()
     delete_unknown_directory()
 
-    for json in database:
+    start = time.perf_counter()
+    image_files = scan_jpg_files(AppConfig.get_output_dir())
+    timings['walk'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    missing_images, orphan_files, cleaned_images = reconcile_library(database, image_files)
+    timings['diff'] = time.perf_counter() - start
+
+    logger.info(f"{len(missing_images)} missing files, {len(orphan_files)} orphan files, "
+                f"{len(cleaned_images)} ad-cleaned descriptions")
+
+    start = time.perf_counter()
+
+    # Digests whose image file is gone for good, dropped by the compaction
+    lost_digests = set()
+
+    for json in missing_images:
         digest = get_digest(json)
-        title = get_title(json)
+        logger.error(f"{AppConfig.get_output_dir()}/{json['image_path']} DO NOT EXISTS!")
+        repaired = process_image(json, force=True)
+        if not repaired or get_digest(json) != digest:
+            lost_digests.add(digest)
+        if repaired:
+            # Downloaded again after the disk scan, counted by check_images_count()
+            image_files.append((get_digest(json), json['image_full_path']))
+
+    for json in cleaned_images:
+        add_image_to_database(json)
+
+    timings['repair'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compact_database(lost_digests)
+    timings['compaction'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    insert_images_from_home(orphan_files)
+    check_images_count(image_files)
+    timings['insert'] = time.perf_counter() - start
+
+    logger.info("Startup timings: " + ", ".join(f"{phase} {seconds:.3f} s" for phase, seconds in timings.items()))
+
+
+def reconcile_library(database, image_files):
+    import logging
+
+    logger = logging.getLogger("reconcile_library")
+
+    output_dir = AppConfig.get_output_dir()
+    disk_paths = {image_path.replace(f"{output_dir}/", "") for digest, image_path in image_files}
+    catalog = get_image_catalog()
+
+    missing_images = []
+    cleaned_images = []
+
+    for json in database:
         description = get_description(json)
-        for ad_text in AppConfig.get_ad():
-            if ad_text in description:
-                logger.info(f"Clean description: {description} at {title} / {digest} image")
-                json['description'] = ""
+        clean_description = clean_ad_description(description)
 
-        image_full_path = f"{AppConfig.get_output_dir()}/{json['image_path']}"
+        if clean_description != description:
+            logger.info(f"Clean description: {description} at {get_title(json)} / {get_digest(json)} image")
 
-        if not check_file_exists(image_full_path):
-            logger.error(f"{image_full_path} DO NOT EXISTS!")
-            process_image(json)
-        else:
-            add_image_to_database(json)
+        if json['image_path'] not in disk_paths:
+            missing_images.append(dict(json, description=clean_description))
+        elif clean_description != description:
+            cleaned_images.append(dict(json, description=clean_description))
+
+    orphan_files = [(digest, image_path) for digest, image_path in image_files if catalog.get(digest) is None]
+
+    return missing_images, orphan_files, cleaned_images
+
+
+def scan_jpg_files(directory):
+    # Same result as get_jpg_files(), but the listing of every directory whose
+    # mtime has not changed since the last startup is taken from the manifest
+    import logging
+    import os
+    import time
+
+    logger = logging.getLogger("scan_jpg_files")
+
+    manifest = read_manifest()
+    new_manifest = {}
+    jpg_files = []
+    scanned = 0
+
+    pending = [""]
+    while pending:
+        relative_dir = pending.pop()
+        path = os.path.join(directory, relative_dir) if relative_dir else directory
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+
+        entry = manifest.get(relative_dir)
+        if not entry or entry['mtime'] != mtime:
+            entry = {'mtime': mtime, 'files': [], 'dirs': []}
+            with os.scandir(path) as entries:
+                for dir_entry in entries:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        # Hidden directories hold state (thumbnail cache), not images
+                        if not dir_entry.name.startswith("."):
+                            entry['dirs'].append(dir_entry.name)
+                    elif dir_entry.name.endswith(".jpg"):
+                        entry['files'].append(dir_entry.name)
+
+            # Changes within the mtime granularity would go unnoticed, scan again next time
+            if time.time_ns() - mtime < 2_000_000_000:
+                entry['mtime'] = None
 
-    insert_images_from_home()
-    check_images_count()
+            scanned = scanned + 1
+
+        new_manifest[relative_dir] = entry
+
+        for file in entry['files']:
+            jpg_files.append((file[:-len(".jpg")], os.path.join(path, file)))
+
+        pending.extend(os.path.join(relative_dir, name) for name in entry['dirs'])
+
+    write_manifest(new_manifest)
+    logger.info(f"{len(jpg_files)} images in {len(new_manifest)} directories, "
+                f"{len(new_manifest) - scanned} unchanged directories skipped")
+
+    return jpg_files
+
+
+def get_manifest_name():
+    return f"{AppConfig.get_output_dir()}/{AppConfig.get_manifest_filename()}"
+
+
+def read_manifest():
+    import json
+    import os
+
+    manifest_name = get_manifest_name()
+    if not os.path.isfile(manifest_name):
+        return {}
+
+    try:
+        with open(manifest_name, 'r') as file:
+            return json.load(file)
+    except ValueError:
+        return {}
+
+
+def write_manifest(manifest):
+    import json
+    import os
+
+    manifest_name = get_manifest_name()
+    with open(f"{manifest_name}.tmp", 'w') as file:
+        json.dump(manifest, file)
+
+    os.replace(f"{manifest_name}.tmp", manifest_name)
+
+
+def clean_ad_description(description):
+    for ad_text in AppConfig.get_ad():
+        if ad_text in description:
+            return ""
+
+    return description
+
+
+def compact_database(drop=()):
+    import logging
+    import time
+
+    logger = logging.getLogger("compact_database")
+    catalog = get_image_catalog()
+
+    dead_ratio = catalog.dead_ratio()
+    threshold = AppConfig.get_compaction_ratio()
+
+    if not drop and dead_ratio < threshold:
+        logger.info(f"No compaction needed: {dead_ratio:.1%} dead rows (threshold {threshold:.1%})")
+        return
+
+    start = time.perf_counter()
+    bytes_before, bytes_after = catalog.compact(drop)
+    duration = time.perf_counter() - start
+
+    logger.info(f"Database compacted in {duration:.3f} s: {dead_ratio:.1%} dead rows, {len(drop)} dropped images, "
+                f"{bytes_before - bytes_after} bytes reclaimed ({bytes_before} -> {bytes_after})")
 
 
 def exists_image(json_image):
     import logging
     logger = logging.getLogger("exists_image")
-    database = read_images_database()
 
     digest = get_digest(json_image)
     image_title = get_title(json_image)
     image_description = get_description(json_image)
-    logger.debug(f"Searching for {digest} / {image_title} in {len(database)} images database ...")
+    logger.debug(f"Searching for {digest} / {image_title} in images database ...")
 
-    for json in database:
-        database_digest = get_digest(json)
-        database_title = get_title(json)
-        database_description = get_description(json)
-        if database_digest == digest:
-            if (database_title == "Unknown" and database_title != image_title or
-                    database_description == "" and image_description != ""):
-                logger.info(f"Upgrading an image: {image_title} / {digest}")
-            else:
-                logger.debug(f"Image {digest} found!")
-                return True
+    database_image, (unknown_title, empty_description) = get_image_catalog().lookup(digest)
 
-    logger.debug(f"Image {image_title} / {digest} not found!")
-    return False
+    if database_image is None:
+        logger.debug(f"Image {image_title} / {digest} not found!")
+        return False
 
+    if unknown_title and image_title != "Unknown" or empty_description and image_description != "":
+        logger.info(f"Upgrading an image: {image_title} / {digest}")
+        return False
 
-def tag_image(image_json):
-    import exif
+    logger.debug(f"Image {digest} found!")
+    return True
 
-    image_name = image_json['image_full_path']
 
-    with open(image_name, 'rb') as img_file:
-        img = exif.Image(img_file)
+def tag_image_data(image_data, image_json):
+    import exif
+
+    img = exif.Image(image_data)
 
     img.image_description = image_json['description'].encode('ascii', 'ignore').decode()
     img.copyright = image_json['copyright'].encode('ascii', 'ignore').decode()
 
-    with open(image_name, 'wb') as new_image_file:
-        new_image_file.write(img.get_file())
+    return img.get_file()
 
 
 def sleep():
@@ -373,37 +859,30 @@ def sleep():
 
 
 def count_images_database():
-    return len(read_images_database())
+    return get_image_catalog().count()
 
 
-def read_images_database(locationPath=None):
-    from datetime import datetime
-    import json
-    import os
+def get_database_generation():
+    # Increases on every change of the images database
+    return get_image_catalog().generation()
 
-    json_database = get_json_database_name(locationPath)
 
-    images_json = {}
+def get_image_catalog():
+    from catalog import ImageCatalog, SqliteImageCatalog
 
-    if os.path.isfile(json_database):
-        with open(json_database, 'r') as archivo_jsonl:
-            for line in archivo_jsonl:
-                json_line = json.loads(line)
+    if AppConfig.get_storage() == "sqlite":
+        return SqliteImageCatalog.instance(get_sqlite_database_name(), get_json_database_name())
 
-                if 'description' not in json_line:
-                    json_line['description'] = ""
+    return ImageCatalog.instance(get_json_database_name(), get_state_name())
 
-                if 'country' not in json_line:
-                    json_line['country'] = "Unknown"
 
-                if 'country_name' not in json_line:
-                    json_line['country_name'] = AppConfig.get_country_name(json_line['country'])
+def read_images_database(locationPath=None):
+    from catalog import ImageCatalog
 
-                hex_digest = json_line['hex_digest']
-                images_json[hex_digest] = json_line
+    if locationPath is None:
+        return get_image_catalog().images()
 
-    return sorted([images_json[key] for key in images_json], reverse=True,
-                  key=lambda x: datetime.strptime(x['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'))
+    return ImageCatalog(get_json_database_name(locationPath)).images()
 
 
 def get_now():
@@ -421,36 +900,61 @@ def get_json_database_name(locationPath=None):
     return f"{location}/{AppConfig.get_json_filename()}"
 
 
-def remove_database():
+def get_sqlite_database_name():
+    return f"{AppConfig.get_output_dir()}/{AppConfig.get_sqlite_filename()}"
+
+
+def get_state_name():
+    return f"{AppConfig.get_output_dir()}/{AppConfig.get_state_filename()}"
+
+
+def get_backup_excluded_files():
+    # Local state files in the output dir that do not belong in a backup
+    return [AppConfig.get_sqlite_filename(), AppConfig.get_state_filename(), AppConfig.get_manifest_filename(),
+            AppConfig.get_harvester_stats_filename(), AppConfig.get_seen_urls_filename(),
+            AppConfig.get_similarity_thumbnails_filename(), AppConfig.get_similarity_state_filename(),
+            AppConfig.get_thumbnails_dirname(), AppConfig.get_import_jobs_dirname()]
+
+
+def export_images_database():
     import logging
-    import os
 
-    logger = logging.getLogger("remove_database")
-    database_name = get_json_database_name()
+    logger = logging.getLogger("export_images_database")
+    json_database = get_json_database_name()
 
-    if os.path.exists(database_name):
-        os.remove(database_name)
-        logger.info(f"Removing database: {database_name}")
+    get_image_catalog().export_jsonl(json_database)
+    logger.info(f"Database exported to {json_database}")
 
 
 def add_image_to_database(image_json):
-    import json
     import logging
 
     logger = logging.getLogger("add_image_to_database")
-    json_database = get_json_database_name()
 
-    if 'image_data' in image_json:
-        del image_json['image_data']
+    discard_image_data(image_json)
 
     if not 'timestamp' in image_json:
         image_json['timestamp'] = get_now()
 
-    with open(json_database, 'a') as file:
-        file.write(json.dumps(image_json))
-        file.write("\n")
+    get_image_catalog().add(image_json)
+
+    logger.debug(f"Save data to {AppConfig.get_storage()} database ..")
+
+
+def add_images_to_database(images_json):
+    # One write for all the images (backup imports)
+    import logging
+
+    logger = logging.getLogger("add_image_to_database")
 
-    logger.debug(f"Save data to {json_database} ..")
+    for image_json in images_json:
+        discard_image_data(image_json)
+        if not 'timestamp' in image_json:
+            image_json['timestamp'] = get_now()
+
+    get_image_catalog().add_all(images_json)
+
+    logger.debug(f"Save {len(images_json)} images to {AppConfig.get_storage()} database ..")
 
 
 def initial_sleep():
@@ -497,41 +1001,87 @@ def copy_file(source_path, destination_path):
         raise e
 
 
-def compress_directory(directory_path, output_filename):
-    import zipfile
-    import os
-    import logging
+class ZipStreamBuffer:
+    # Write-only, unseekable file for zipfile: it writes data descriptors after
+    # every member, and what it writes is taken out in chunks to be sent
 
-    logger = logging.getLogger("compress_directory")
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.position = 0
 
-    try:
-        with zipfile.ZipFile(output_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(directory_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, directory_path)
-                    zipf.write(file_path, arcname)
-
-        logger.info(f"Directory '{directory_path}' compressed to '{output_filename}' successfully.")
-    except BaseException as e:
-        logger.error(f"Error compressing directory '{directory_path}': {e}")
-        raise e
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size = self.size + len(data)
+        self.position = self.position + len(data)
+        return len(data)
 
+    def tell(self):
+        return self.position
 
-def decompress_zipfile(archive_path, output_directory):
-    import zipfile
+    def seek(self, *args):
+        import io
+
+        raise io.UnsupportedOperation("seek")
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def stream_directory_zip(directory_path, exclude=(), chunk_size=1024 * 1024):
+    # Yields the zip archive of a directory as it is built, never more than
+    # about a chunk in memory. JPEGs do not compress, they are stored; the
+    # rest (the JSONL database) is deflated.
     import logging
+    import os
+    import zipfile
 
-    logger = logging.getLogger("decompress_file")
+    logger = logging.getLogger("stream_directory_zip")
+    stream = ZipStreamBuffer()
+    files = 0
 
-    try:
-        with zipfile.ZipFile(archive_path, "r") as zipf:
-            zipf.extractall(path=output_directory)
+    with zipfile.ZipFile(stream, "w") as zipf:
+        for root, dirs, file_names in os.walk(directory_path):
+            dirs.sort()
+            for file in sorted(file_names):
+                file_path = os.path.join(root, file)
+                arcname = os.path.relpath(file_path, directory_path)
+                if arcname.startswith(tuple(exclude)):
+                    continue
 
-        logger.info(f"Archive '{archive_path}' extracted to '{output_directory}' successfully.")
-    except BaseException as e:
-        logger.error(f"Error extracting archive '{archive_path}': {e}")
-        raise e
+                try:
+                    zip_info = zipfile.ZipInfo.from_file(file_path, arcname)
+                    source = open(file_path, 'rb')
+                except FileNotFoundError:
+                    continue
+
+                zip_info.compress_type = zipfile.ZIP_STORED if file.endswith(".jpg") else zipfile.ZIP_DEFLATED
+
+                # Only the bytes there were when listed: appends to the database can not break a line
+                remaining = zip_info.file_size
+                with source, zipf.open(zip_info, 'w') as destination:
+                    while remaining > 0:
+                        chunk = source.read(min(chunk_size, remaining))
+                        if not chunk:
+                            break
+                        remaining = remaining - len(chunk)
+                        destination.write(chunk)
+
+                        if stream.size >= chunk_size:
+                            yield stream.pop()
+
+                files = files + 1
+                if stream.size >= chunk_size:
+                    yield stream.pop()
+
+    yield stream.pop()
+    logger.info(f"Directory '{directory_path}' streamed as a zip archive of {files} files")
 
 
 def delete_directory(directory):
@@ -583,19 +1133,42 @@ def delete_unknown_image(image_json):
         logger.debug(f"File '{path}' not found!")
 
 
-def process_image(image_json):
+def process_image(image_json, force=False):
     import logging
     import traceback
 
     logger = logging.getLogger("process_image")
     try:
         download_image(image_json)
-        if not exists_image(image_json):
+        return store_image(image_json, force)
+
+    except BaseException as error:
+        logger.error(f"Error processing image {image_json['title']}: {error} ")
+        traceback.print_exc()
+
+    return False
+
+
+def store_image(image_json, force=False):
+    import logging
+    import traceback
+    from thumbnails import schedule_thumbnails
+
+    logger = logging.getLogger("process_image")
+    try:
+        if force or not exists_image(image_json):
+            if AppConfig.is_dedupe_enabled():
+                from dedupe import check_near_duplicate
+
+                if check_near_duplicate(image_json):
+                    return False
+
             delete_unknown_image(image_json)
             save_image(image_json)
-            tag_image(image_json)
+            discard_image_data(image_json)
 
             add_image_to_database(image_json)
+            schedule_thumbnails(image_json)
 
             logger.info(f"Downloaded {image_json['title']} into {image_json['image_full_path']} ...")
             return True
@@ -604,74 +1177,151 @@ def process_image(image_json):
         logger.error(f"Error processing image {image_json['title']}: {error} ")
         traceback.print_exc()
 
+    finally:
+        discard_image_data(image_json)
+
     return False
 
 
-def insert_images_from_backup(backup_dir, id_new):
+def process_images(items, stats=None):
+    # Downloads run in a bounded thread pool, while saving, tagging and the
+    # database appends stay in the calling thread and in the order of items.
+    # Items whose URL is already known are not downloaded at all.
+    # Yields (item, True if it is a new image).
     import logging
-    import json
+    import time
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    logger = logging.getLogger("process_images")
+    threads = AppConfig.get_download_threads()
+    seen_urls = get_seen_url_index()
+
+    if stats is None:
+        stats = {}
+    stats.update({'items': 0, 'new': 0, 'errors': 0, 'bytes': 0, 'skipped': 0, 'bytes_saved': 0,
+                  'start': time.perf_counter()})
+
+    def finish(item, future):
+        stats['items'] += 1
+        try:
+            etag = future.result() if future else None
+        except BaseException as error:
+            logger.error(f"Error downloading image {item['title']}: {error}")
+            stats['errors'] += 1
+            return item, False
+
+        if 'image_file' not in item and seen_urls.is_rejected(item['hex_digest']):
+            # Rejected as a near duplicate before, it is not stored either
+            stats['skipped'] += 1
+            return item, False
+
+        if 'image_file' not in item:
+            if future:
+                seen_urls.add(item['image_url_landscape'], item['hex_digest'], etag)
+            new_image = store_known_image(item, stats)
+        else:
+            stats['bytes'] += item['image_size']
+            # Known content under a new URL, or a URL repeated in this batch
+            known = exists_image(item)
+            if known:
+                discard_image_data(item)
+                new_image = False
+            else:
+                new_image = store_image(item)
+
+            # Marked once the image is stored or rejected, so a rejected URL is skipped next time
+            rejected = 'near_duplicate_of' in item
+            seen_urls.add(item['image_url_landscape'], item['hex_digest'], etag, rejected)
+            if not new_image:
+                # store_image() logs its own errors, so items = new + skipped + errors
+                stats['skipped' if known or rejected else 'errors'] += 1
+
+        if new_image:
+            stats['new'] += 1
+
+        return item, new_image
+
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="download") as executor:
+        pending = deque()
+        for item in items:
+            hex_digest = seen_urls.get(item['image_url_landscape'])
+            if hex_digest and (get_local_image_path(hex_digest) or seen_urls.is_rejected(hex_digest)):
+                item['hex_digest'] = hex_digest
+                pending.append((item, None))
+            else:
+                etag_digest, etag = seen_urls.get_asset(item['image_url_landscape'])
+                if not (get_local_image_path(etag_digest) or seen_urls.is_rejected(etag_digest)):
+                    etag = None
+                pending.append((item, executor.submit(download_image, item, etag, etag_digest)))
 
-    logger = logging.getLogger("insert_images_from_backup")
+            if len(pending) >= threads * 2:
+                yield finish(*pending.popleft())
 
-    logger.info(f"Backup Dir: {backup_dir}")
-    images = read_images_database(backup_dir)
+        while pending:
+            yield finish(*pending.popleft())
 
-    for image in images:
-        logger.debug(json.dumps(image, indent=3))
-        if not exists_image(image):
-            logger.info(f"Adding image: {image['title']}")
+    stats['elapsed'] = time.perf_counter() - stats['start']
 
-            from_path = f"{backup_dir}/{image['image_path']}"
-            if not check_file_exists(from_path):
-                logger.error(f"{from_path} DO NOT EXISTS: \n{json.dumps(image, indent=3)}")
-                process_image(image)
 
-            else:
-                make_image_directory(image)
+def store_known_image(image_json, stats):
+    # The image is already in the library: skip it, or upgrade its metadata
+    # following the exists_image() rules using the local copy of the file
+    import logging
+    import os
+    from io import BytesIO
 
-                copy_file(from_path, image['image_full_path'])
-                image['timestamp'] = get_now()
-                image['id-new'] = id_new
-                add_image_to_database(image)
+    logger = logging.getLogger("store_known_image")
+    image_full_path = get_local_image_path(image_json['hex_digest'])
 
+    if image_full_path:
+        stats['bytes_saved'] += os.path.getsize(image_full_path)
 
-def get_file_count(directory):
-    import os
-    count = 0
-    for root, dirs, files in os.walk(directory):
-        count += len(files)
-    return count
+    if exists_image(image_json):
+        stats['skipped'] += 1
+        return False
 
+    if not image_full_path:
+        logger.error(f"Local copy of {image_json['hex_digest']} not found, it will be downloaded next time")
+        stats['errors'] += 1
+        return False
 
-def get_file_date(directory):
-    import os
-    import datetime
+    with open(image_full_path, 'rb') as file:
+        image_json['image_data'] = BytesIO(file.read())
+
+    if store_image(image_json):
+        return True
 
-    date = os.path.getctime(directory)
-    return datetime.datetime.fromtimestamp(date)
+    stats['skipped' if 'near_duplicate_of' in image_json else 'errors'] += 1
+    return False
+
+
+def get_download_stats_message(stats):
+    elapsed = max(stats['elapsed'], 0.001)
+    return (f"{stats['new']}/{stats['items']} new images, {stats['skipped']} known images skipped, "
+            f"{stats['errors']} errors, {stats['bytes'] / 1024 / 1024:.1f} MB in {elapsed:.2f} s "
+            f"({stats['items'] / elapsed:.1f} images/s, {stats['bytes'] / 1024 / 1024 / elapsed:.2f} MB/s), "
+            f"{stats['bytes_saved'] / 1024 / 1024:.1f} MB saved")
 
 
 def get_links(grouped_terms=[]):
-    import os
+    from datetime import datetime
 
-    images_dir = AppConfig.get_output_dir()
+    reconcile_links()
 
     subdirectories = []
     term_counts = {term: 0 for term in grouped_terms}
     term_date = {}
 
-    for name in os.listdir(images_dir):
-        subdir_path = os.path.join(images_dir, name)
-        if os.path.isdir(subdir_path):
-            for term in grouped_terms:
-                if term.lower() in name.lower():
-                    term_counts[term] += get_file_count(subdir_path)
-                    term_date[term] = get_file_date(subdir_path)
-                    break
-            else:
-                file_count = get_file_count(subdir_path)
-                date = get_file_date(subdir_path)
-                subdirectories.append((name, file_count, date))
+    for name, (file_count, latest) in get_image_catalog().facets().items():
+        date = datetime.fromisoformat(latest)
+        for term in grouped_terms:
+            if term.lower() in name.lower():
+                term_counts[term] += file_count
+                term_date[term] = max(term_date.get(term, date), date)
+                break
+        else:
+            subdirectories.append((name, file_count, date))
 
     for term, count in term_counts.items():
         if count:
@@ -680,11 +1330,41 @@ def get_links(grouped_terms=[]):
     return sorted(subdirectories, key=lambda x: (x[1], x[2]), reverse=True)
 
 
-def template_and_search_terms(startup_time, text, image_list, href):
+links_reconcile_time = 0
+
+
+def reconcile_links():
+    # Compare the folder counters of the catalog with the files on disk, at most
+    # once every general.links.reconcile.time seconds (0 disables it)
+    import logging
+    import os
+    import time
+
+    global links_reconcile_time
+
+    interval = AppConfig.get_links_reconcile_time()
+    if not interval or time.time() - links_reconcile_time < interval:
+        return
+
+    logger = logging.getLogger("reconcile_links")
+    links_reconcile_time = time.time()
+
+    images_dir = AppConfig.get_output_dir()
+    facets = get_image_catalog().facets()
+
+    for name in os.listdir(images_dir):
+        subdir_path = os.path.join(images_dir, name)
+        if os.path.isdir(subdir_path) and not name.startswith("."):
+            files = sum(len([file for file in files if file.endswith(".jpg")]) for _, _, files in os.walk(subdir_path))
+            images = facets.get(name, (0, None))[0]
+            if files != images:
+                logger.warning(f"Folder {name} has {files} images on disk and {images} in the database")
+
+
+def template_and_search_terms(startup_time, text, image_list, href, total_items=None, generation=None):
     from bottle import template, request
     import math
 
-    images = read_images_database()
     search_terms = get_links(grouped_terms=["Painting", "Galaxy"])
 
     current_page = int(request.query.get('page', 1))
@@ -692,7 +1372,12 @@ def template_and_search_terms(startup_time, text, image_list, href):
     start_index = (current_page - 1) * per_page
     end_index = start_index + per_page
 
-    total_pages = math.ceil(len(image_list) / per_page)
+    # When total_items is given, image_list is already the requested page
+    if total_items is None:
+        total_items = len(image_list)
+        image_list = image_list[start_index:end_index]
+
+    total_pages = math.ceil(total_items / per_page)
     pages_to_show = min(8, total_pages)
     start_page = max(1, current_page - (pages_to_show // 2))
     end_page = start_page + pages_to_show - 1
@@ -703,7 +1388,10 @@ def template_and_search_terms(startup_time, text, image_list, href):
     ellipsis_before = start_page > 1
     ellipsis_after = end_page < total_pages
 
-    total_images = len(images)
+    total_images = count_images_database()
+    # The first page of the latest images shows the new ones as they arrive,
+    # following the events from the generation it was rendered with
+    live = href == "/" and current_page == 1 and AppConfig.get_events_port() > 0
     href = href + ("&" if "?" in href else "?")
 
     base_url = request.urlparts.scheme + "://" + request.urlparts.netloc
@@ -711,7 +1399,7 @@ def template_and_search_terms(startup_time, text, image_list, href):
     return template('index.html',
                     counter=total_images,
                     text=text,
-                    imagelist=image_list[start_index:end_index],
+                    imagelist=image_list,
                     search_terms=search_terms,
                     current_page=current_page,
                     total_pages=total_pages,
@@ -720,24 +1408,112 @@ def template_and_search_terms(startup_time, text, image_list, href):
                     ellipsis_before=ellipsis_before,
                     ellipsis_after=ellipsis_after,
                     base_url=base_url,
-                    seconds=get_uptime_message(startup_time),
+                    startup=int(startup_time.timestamp() * 1000),
+                    thumbnail_size=AppConfig.get_thumbnail_size(),
+                    live=live,
+                    generation=get_database_generation() if generation is None else generation,
+                    per_page=per_page,
                     href=href)
 
 
-def search_term_database(search_term):
-    images = read_images_database()
-    return [item for item in images if search_term.lower() in (
-            item['title'] + item['description'] + item['hex_digest'] + item['timestamp']).lower()]
+def encode_cursor(key):
+    import base64
+    import json
+
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for a malformed cursor
+    import base64
+    import json
+
+    key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    if not isinstance(key, list) or len(key) != 2 or not all(isinstance(item, str) for item in key):
+        raise ValueError(f"Invalid cursor {cursor}")
+
+    return tuple(key)
+
+
+def query_images_database(field=None, value=None, limit=None, cursor=None, offset=0):
+    # Newest images first, all of them or those with a field ('search', 'country',
+    # 'folder' or 'id-new') value. Pages follow the (timestamp, hex_digest)
+    # cursor returned with the previous page, or skip `offset` images.
+    if limit is None:
+        limit = AppConfig.get_images_per_page()
+
+    before = decode_cursor(cursor) if cursor else None
+    images, next_key = get_image_catalog().page(field, value, limit, before, offset)
+
+    return images, encode_cursor(next_key) if next_key else None
+
+
+def count_query_images_database(field=None, value=None):
+    return get_image_catalog().page_count(field, value)
+
+
+def get_shuffle_permutation(seed, size):
+    # Keyed bijection on [0, size): a 4 round Feistel network on the smallest
+    # even number of bits covering size, walking the cycle until the result is
+    # in range. Any page is computed without the whole permutation.
+    from hashlib import blake2b
+
+    half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+    mask = (1 << half_bits) - 1
+    keys = [blake2b(f"{seed}-{size}-{index}".encode(), digest_size=16).digest() for index in range(4)]
+
+    def round_function(key, value):
+        return int.from_bytes(blake2b(value.to_bytes(8, 'little'), key=key, digest_size=8).digest(), 'little') & mask
+
+    def permute(position):
+        value = position
+        while True:
+            left, right = value >> half_bits, value & mask
+            for key in keys:
+                left, right = right, left ^ round_function(key, right)
+            value = (left << half_bits) | right
+            # At most 4 times the size, a few steps on average
+            if value < size:
+                return value
+
+    return permute
+
+
+def random_images_database(limit=None, seed=None, size=None, offset=0):
+    # Random images in O(limit), picked by position in the catalog. Without a
+    # seed a new sample every time; with a seed the images from `offset` of a
+    # shuffle of the first `size` images, the same for the same seed and size.
+    import random
+
+    if limit is None:
+        limit = AppConfig.get_images_per_page()
+
+    catalog = get_image_catalog()
+    count = catalog.count()
+
+    if seed is None:
+        return catalog.images_at(random.sample(range(count), min(limit, count)))
+
+    size = count if size is None else min(size, count)
+    permute = get_shuffle_permutation(seed, size)
+    return catalog.images_at([permute(position) for position in range(offset, min(offset + limit, size))])
+
+
+def search_term_database(search_term, limit=None, offset=0):
+    return get_image_catalog().search(search_term, limit, offset)
+
+
+def count_search_term_database(search_term):
+    return get_image_catalog().search_count(search_term)
 
 
 def search_digest_database(search_term):
-    images = read_images_database()
-    return [item for item in images if search_term == item['hex_digest']]
+    image = get_image_catalog().get(search_term)
+    return [image] if image else []
 
 
 def search_id_database(search_term):
-    images = read_images_database()
-    return [item for item in images if search_term in ("" if "id-new" not in item else item['id-new'])]
+    return get_image_catalog().search_id(search_term)
 
 
 def generate_id(length=10):
@@ -928,15 +1704,18 @@ def get_jpg_files(directory):
     return jpg_files
 
 
-def insert_images_from_home():
+def insert_images_from_home(image_files=None):
     import logging
 
     logger = logging.getLogger("insert_images_from_home")
 
     logger.info("Inserting images from home directory")
 
+    if image_files is None:
+        image_files = get_jpg_files(AppConfig.get_output_dir())
+
     images = 0
-    for digest, image_path in get_jpg_files(AppConfig.get_output_dir()):
+    for digest, image_path in image_files:
         if not search_digest_database(digest):
             image_path = image_path.replace("\\", "/")
             image_json = {'image_url_landscape': f"./image/{digest}", 'title': get_title_from_path(image_path),
@@ -952,17 +1731,18 @@ def insert_images_from_home():
     logger.info(f"{images} images has been inserted from home dir!")
 
 
-def check_images_count():
+def check_images_count(images_from_disk=None):
     import logging
 
     logger = logging.getLogger("check_images_count")
 
     logger.info("Checking images from disk...")
 
-    images_from_disk = get_jpg_files(AppConfig.get_output_dir())
+    if images_from_disk is None:
+        images_from_disk = get_jpg_files(AppConfig.get_output_dir())
+
     len_images_from_disk = len(images_from_disk)
-    images = read_images_database()
-    len_images = len(images)
+    len_images = count_images_database()
 
     if len_images != len_images_from_disk:
         logger.error(f"Images from disk ({len_images_from_disk}) are not equal than database ({len_images}) !!!")
@@ -980,34 +1760,3 @@ def get_current_time():
     from datetime import datetime
 
     return datetime.now()
-
-
-def get_uptime_message(start_time):
-    from datetime import datetime
-
-    current_seconds = int((datetime.now() - start_time).total_seconds())
-
-    days = current_seconds // 86400
-    current_seconds %= 86400
-
-    hours = current_seconds // 3600
-    current_seconds %= 3600
-
-    minutes = current_seconds // 60
-    seconds = current_seconds % 60
-
-    message = ""
-
-    if days > 0:
-        message = f"{days} day" if days == 1 else f"{days} days"
-
-    if hours > 0:
-        message = f"{message} {hours} hour" if hours == 1 else f"{message} {hours} hours"
-
-    if minutes > 0 and days == 0:
-        message = f"{message} {minutes} minute" if minutes == 1 else f"{message} {minutes} minutes"
-
-    if seconds > 0 and days == 0 and hours == 0:
-        message = f"{message} {seconds} second" if seconds == 1 else f"{message} {seconds} seconds"
-
-    return message